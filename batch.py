@@ -0,0 +1,296 @@
+"""
+Headless batch watermarking: applies one parameter set to a directory or ZIP of PDFs.
+
+    python batch.py INPUT PARAMS.json -o OUTPUT_DIR [-j WORKERS]
+
+INPUT is a directory (searched recursively) or a .zip file. PARAMS.json holds the same
+settings the bot asks for, e.g.
+
+    {"location": 9, "watermark_text": "CONFIDENTIAL", "text_size": 24, "color": "red",
+     "find_text": "Acme Corp"}
+
+with "side_coords": [[v, h], [v, h]] for location 10. For location 9, "find_region" (two
+[v, h] corners) limits the search to part of each page and "ocr_options" overrides OCR
+settings, e.g. {"psm": 6, "lang": "eng+deu"}. For locations 9 and 10, "cover_mode" is
+"cover" (white box) or "redact" (remove the text underneath), and "redact_images" is
+"keep", "blank" or "remove". Outputs mirror the input layout under OUTPUT_DIR, and every
+finished file is appended to OUTPUT_DIR/manifest.jsonl with its status, timing, input and
+output size, and error. Rerunning the same command resumes: files already recorded as
+done (with their output present) are skipped. OUTPUT_DIR must not be the input directory;
+when it lies inside it, it is not searched for input. A file that crashes its worker
+process is recorded as failed without stopping the run. No Telegram credentials are needed.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import logging
+import argparse
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from watermark import COLOR_MAPPING, COVER_MODES, REDACT_IMAGE_MODES, create_watermarked_pdf
+from ocr import ocr_settings
+from geometry import check_normalized_region
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.jsonl"
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+
+def load_params(params_path):
+    """
+    Reads and validates a JSON parameter file. Returns the parameters as a dict.
+    """
+    with open(params_path, encoding="utf-8") as f:
+        params = json.load(f)
+    location = params.get("location")
+    if not isinstance(location, int) or not 1 <= location <= 10:
+        raise ValueError("location must be a number between 1 and 10")
+    if not params.get("watermark_text"):
+        raise ValueError("watermark_text is required")
+    if not isinstance(params.get("text_size"), (int, float)):
+        raise ValueError("text_size must be a number")
+    if params.get("color", "black") not in COLOR_MAPPING:
+        raise ValueError(f"color must be one of: {', '.join(COLOR_MAPPING)}")
+    if location == 9 and not params.get("find_text"):
+        raise ValueError("find_text is required for location 9")
+    if location == 10:
+        coords = params.get("side_coords")
+        if not coords or len(coords) != 2 or any(len(coord) != 2 for coord in coords):
+            raise ValueError("side_coords must hold two [v, h] pairs for location 10")
+    if params.get("find_region") is not None:
+        try:
+            check_normalized_region(params["find_region"])
+        except ValueError as e:
+            raise ValueError(f"find_region must hold two [v, h] pairs spanning an area: {e}")
+    if params.get("ocr_options") is not None:
+        ocr_settings(**params["ocr_options"])
+    if params.get("cover_mode") is not None and params["cover_mode"] not in COVER_MODES:
+        raise ValueError(f"cover_mode must be one of: {', '.join(COVER_MODES)}")
+    if params.get("redact_images") is not None and params["redact_images"] not in REDACT_IMAGE_MODES:
+        raise ValueError(f"redact_images must be one of: {', '.join(REDACT_IMAGE_MODES)}")
+    return params
+
+def collect_inputs(input_path, exclude_dir=None):
+    """
+    Lists the PDFs to process as (relative_name, zip_member or None), sorted by name.
+    When input_path is a directory, exclude_dir (the output directory, which may lie
+    inside it) is not searched.
+    """
+    if zipfile.is_zipfile(input_path):
+        with zipfile.ZipFile(input_path) as archive:
+            names = [info.filename for info in archive.infolist()
+                     if not info.is_dir() and info.filename.lower().endswith(".pdf")]
+        inputs = []
+        for name in names:
+            relative = os.path.normpath(name)
+            if os.path.isabs(relative) or relative.startswith(".."):
+                logger.warning("Skipping ZIP member outside the archive root: %s", name)
+                continue
+            inputs.append((relative, name))
+        return sorted(inputs)
+    inputs = []
+    excluded = os.path.realpath(exclude_dir) if exclude_dir else None
+    for root, dirs, files in os.walk(input_path):
+        dirs[:] = [name for name in dirs if os.path.realpath(os.path.join(root, name)) != excluded]
+        for name in files:
+            if name.lower().endswith(".pdf"):
+                relative = os.path.relpath(os.path.join(root, name), input_path)
+                inputs.append((relative, None))
+    return sorted(inputs)
+
+def load_manifest(output_dir):
+    """
+    Returns {relative_name: record} with the latest manifest record of each file.
+    """
+    records = {}
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return records
+    with open(manifest_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A crash can leave a truncated last line.
+                continue
+            records[record["file"]] = record
+    return records
+
+def process_one(input_path, relative_name, member, output_dir, params):
+    """
+    Watermarks one PDF. Runs in a worker process and returns its manifest record.
+    The output is written under a temporary name and renamed when complete, so an
+    interrupted run never leaves a partial file that looks finished.
+    """
+    started = time.time()
+    output_path = os.path.join(output_dir, relative_name)
+    record = {"file": relative_name, "output": relative_name}
+    work_dir = tempfile.mkdtemp(prefix="pdfwm-batch-")
+    try:
+        if member is None:
+            source_path = os.path.join(input_path, relative_name)
+        else:
+            source_path = os.path.join(work_dir, "input.pdf")
+            with zipfile.ZipFile(input_path) as archive, archive.open(member) as src, open(source_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        temp_output = os.path.join(work_dir, "output.pdf")
+        create_watermarked_pdf(
+            source_path, params["watermark_text"], params["text_size"],
+            COLOR_MAPPING[params.get("color", "black")], params["location"],
+            find_text=params.get("find_text"),
+            cover_coords=[tuple(coord) for coord in params["side_coords"]] if params.get("side_coords") else None,
+            output_pdf_path=temp_output, ocr_workers=1,
+            ocr_region=[tuple(coord) for coord in params["find_region"]] if params.get("find_region") else None,
+            ocr_options=params.get("ocr_options"), cover_mode=params.get("cover_mode"),
+            redact_images=params.get("redact_images")
+        )
+        record["bytes_in"] = os.path.getsize(source_path)
+        record["bytes_out"] = os.path.getsize(temp_output)
+        shutil.move(temp_output, output_path)
+        record["status"] = STATUS_OK
+    except Exception as e:
+        record["status"] = STATUS_FAILED
+        record["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    record["seconds"] = round(time.time() - started, 3)
+    record["finished"] = time.time()
+    return record
+
+def check_output_dir(input_path, output_dir):
+    """
+    Raises ValueError if writing outputs to output_dir would overwrite the input PDFs.
+    """
+    if os.path.isdir(input_path) and os.path.realpath(input_path) == os.path.realpath(output_dir):
+        raise ValueError("the output directory must differ from the input directory")
+
+def crash_record(relative_name):
+    """Returns the manifest record of a file whose worker process died."""
+    return {"file": relative_name, "output": relative_name, "status": STATUS_FAILED,
+            "error": "BrokenProcessPool: the worker process died (out of memory or a crash)",
+            "finished": time.time()}
+
+def run_files(files, workers, input_path, output_dir, params, on_record):
+    """
+    Processes files ((relative_name, member) pairs) across `workers` processes, passing
+    each manifest record to on_record. Only `workers` files are handed to the pool at
+    a time, so when a worker process dies only the files then running are affected:
+    the pool is replaced and those files are returned, unprocessed, for a rerun.
+    """
+    pending = list(reversed(files))
+    running = {}
+    interrupted = []
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                relative_name, member = pending.pop()
+                future = executor.submit(process_one, input_path, relative_name, member, output_dir, params)
+                running[future] = (relative_name, member)
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            for future in finished:
+                relative_name, member = running.pop(future)
+                error = future.exception()
+                if isinstance(error, BrokenProcessPool):
+                    interrupted.append((relative_name, member))
+                    broken = True
+                elif error is not None:
+                    on_record({"file": relative_name, "output": relative_name, "status": STATUS_FAILED,
+                               "error": f"{type(error).__name__}: {error}", "finished": time.time()})
+                else:
+                    on_record(future.result())
+            if broken:
+                # Every other running file fails with the same error; wait for them too.
+                for future in wait(running)[0]:
+                    relative_name, member = running.pop(future)
+                    if future.exception() is None:
+                        on_record(future.result())
+                    else:
+                        interrupted.append((relative_name, member))
+                logger.warning("A worker process died; restarting the pool")
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=workers)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return interrupted
+
+def run_batch(input_path, params, output_dir, workers, retry_failed=True):
+    """
+    Processes every PDF of input_path across `workers` processes, skipping files the
+    manifest already records as done. Returns (succeeded, failed, skipped) counts.
+
+    A file whose worker process dies fails on its own: the files that were running at
+    the time are rerun one at a time, and the one that kills its worker again is
+    recorded as failed. Raises ValueError if output_dir is the input directory.
+    """
+    check_output_dir(input_path, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    done = load_manifest(output_dir)
+    pending = []
+    skipped = 0
+    for relative_name, member in collect_inputs(input_path, exclude_dir=output_dir):
+        record = done.get(relative_name)
+        if record and record["status"] == STATUS_OK and os.path.exists(os.path.join(output_dir, record["output"])):
+            skipped += 1
+        elif record and record["status"] == STATUS_FAILED and not retry_failed:
+            skipped += 1
+        else:
+            pending.append((relative_name, member))
+    logger.info("%d file(s) to process, %d already done", len(pending), skipped)
+
+    counts = {STATUS_OK: 0, STATUS_FAILED: 0}
+    started = time.time()
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        def on_record(record):
+            manifest.write(json.dumps(record) + "\n")
+            manifest.flush()
+            counts[record["status"]] += 1
+            if record["status"] == STATUS_OK:
+                logger.info("Done %s in %.2fs (%d -> %d bytes)", record["file"], record["seconds"],
+                            record["bytes_in"], record["bytes_out"])
+            else:
+                logger.error("Failed %s: %s", record["file"], record["error"])
+
+        interrupted = run_files(pending, max(1, workers), input_path, output_dir, params, on_record)
+        for relative_name, member in interrupted:
+            if run_files([(relative_name, member)], 1, input_path, output_dir, params, on_record):
+                on_record(crash_record(relative_name))
+    succeeded, failed = counts[STATUS_OK], counts[STATUS_FAILED]
+    logger.info("Batch finished in %.1fs: %d succeeded, %d failed, %d skipped",
+                time.time() - started, succeeded, failed, skipped)
+    return succeeded, failed, skipped
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watermark a directory or ZIP of PDFs with one parameter set.")
+    parser.add_argument("input", help="directory or .zip file of PDFs")
+    parser.add_argument("params", help="JSON file with the watermark parameters")
+    parser.add_argument("-o", "--output-dir", required=True, help="directory for outputs and manifest.jsonl")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--skip-failed", action="store_true", help="do not retry files that failed in an earlier run")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    try:
+        params = load_params(args.params)
+    except (OSError, ValueError) as e:
+        parser.error(f"invalid parameter file: {e}")
+    if not os.path.exists(args.input):
+        parser.error(f"input not found: {args.input}")
+    try:
+        check_output_dir(args.input, args.output_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    _, failed, _ = run_batch(args.input, params, args.output_dir, args.workers, retry_failed=not args.skip_failed)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""
+Benchmarks every create_watermarked_pdf mode on a locally generated synthetic corpus.
+
+    python benchmark.py [--sizes 1,100,1000] [--kinds text,scanned,mixed]
+                        [--modes standard,legacy,cover,cover-rgb150,cover-region,redact,sides]
+                        [--save-baseline FILE] [--compare FILE]
+
+Corpus kinds: "text" (born-digital pages with a text layer), "scanned" (image-only pages,
+so Cover-Up must OCR them) and "mixed" (text pages of varying sizes and rotations). Each
+case runs in a fresh process and reports pages/sec, peak RSS, output size and the time
+spent per phase (render, ocr, search, draw, save). Results can be saved as a baseline and
+later runs compared against it; --compare exits with status 1 on a regression.
+The cover-rgb150 and cover-region modes show what the OCR front-end settings (grayscale
+and adaptive DPI, search area) gain over the original OCR on scanned pages; redact runs
+Cover-Up with true redaction instead of white boxes.
+Everything runs offline; Cover-Up on scanned pages needs tesseract installed.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import logging
+import multiprocessing
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+FIND_TEXT = "Confidential"
+MODES = {
+    "standard": {"location": 4},
+    "legacy": {"location": 4, "stamp_engine": "legacy"},
+    "cover": {"location": 9, "find_text": FIND_TEXT},
+    # OCR as originally done: RGB pages at a fixed 150 dpi.
+    "cover-rgb150": {"location": 9, "find_text": FIND_TEXT,
+                     "ocr_options": {"grayscale": False, "adaptive_dpi": False, "dpi": 150}},
+    "cover-region": {"location": 9, "find_text": FIND_TEXT, "ocr_region": [(0, 0), (5, 10)]},
+    "redact": {"location": 9, "find_text": FIND_TEXT, "cover_mode": "redact"},
+    "sides": {"location": 10, "cover_coords": [(1, 1), (2, 9)]},
+}
+PAGE_SIZES = [(595, 842, 0), (842, 595, 0), (612, 792, 90), (420, 595, 0), (595, 842, 270)]
+LINES_PER_PAGE = 30
+
+def _text_page(doc, page_number, width=595, height=842, rotation=0):
+    page = doc.new_page(width=width, height=height)
+    y = 60
+    for line in range(LINES_PER_PAGE):
+        words = f"Page {page_number} line {line}: quarterly figures for {FIND_TEXT} review"
+        page.insert_text((50, y), words, fontsize=11)
+        y += (height - 100) / LINES_PER_PAGE
+    if rotation:
+        page.set_rotation(rotation)
+    return page
+
+def generate_pdf(path, kind, pages):
+    """
+    Writes one synthetic PDF of the given kind and page count.
+    """
+    doc = fitz.open()
+    if kind == "scanned":
+        source = fitz.open()
+        for page_number in range(pages):
+            text_page = _text_page(source, page_number)
+            pix = text_page.get_pixmap(dpi=150, colorspace=fitz.csGRAY)
+            page = doc.new_page(width=text_page.rect.width, height=text_page.rect.height)
+            page.insert_image(page.rect, pixmap=pix)
+        source.close()
+    else:
+        for page_number in range(pages):
+            if kind == "mixed":
+                width, height, rotation = PAGE_SIZES[page_number % len(PAGE_SIZES)]
+                _text_page(doc, page_number, width, height, rotation)
+            else:
+                _text_page(doc, page_number)
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+
+def generate_corpus(corpus_dir, kinds, sizes):
+    """
+    Creates the corpus files that do not exist yet and returns {(kind, pages): path}.
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = {}
+    for kind in kinds:
+        for pages in sizes:
+            path = os.path.join(corpus_dir, f"{kind}-{pages}.pdf")
+            if not os.path.exists(path):
+                logger.info("Generating %s", path)
+                generate_pdf(path, kind, pages)
+            corpus[(kind, pages)] = path
+    return corpus
+
+def peak_rss_mb():
+    """
+    Returns this process's peak resident memory in MB. VmHWM is used where available
+    because, unlike ru_maxrss, it is not inherited from the parent across fork/exec.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _run_case(input_path, output_path, mode, result_queue):
+    # Runs in a fresh process so peak RSS belongs to this case only.
+    from reportlab.lib.colors import red
+    import metrics
+    from watermark import create_watermarked_pdf
+    from ocr import shutdown_shard_pool
+
+    options = dict(MODES[mode])
+    location = options.pop("location")
+    started = time.perf_counter()
+    try:
+        create_watermarked_pdf(input_path, "BENCHMARK", 18, red, location, output_pdf_path=output_path, **options)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - started
+    shutdown_shard_pool()
+    # OCR worker processes are forked from this small process and have exited, so ru_maxrss
+    # is reliable for them.
+    rss_mb = max(peak_rss_mb(), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+    phases = {phase: round(total, 4) for phase, (total, _) in metrics.phase_snapshot().items()}
+    result_queue.put({"seconds": seconds, "peak_rss_mb": rss_mb, "phases": phases, "error": error})
+
+def run_case(input_path, mode, pages, work_dir):
+    """
+    Benchmarks one mode on one file in a spawned process and returns its result dict.
+    """
+    output_path = os.path.join(work_dir, f"out-{mode}-{os.path.basename(input_path)}")
+    context = multiprocessing.get_context("spawn")
+    result_queue = context.Queue()
+    process = context.Process(target=_run_case, args=(input_path, output_path, mode, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    result["pages_per_sec"] = pages / result["seconds"] if result["seconds"] else 0.0
+    result["output_bytes"] = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    return result
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of regression messages: cases whose pages/sec fell, or whose peak RSS
+    or output size grew, by more than tolerance (a fraction) relative to the baseline.
+    """
+    regressions = []
+    for case, result in results.items():
+        old = baseline.get(case)
+        if not old or result["error"] or old.get("error"):
+            continue
+        if result["pages_per_sec"] < old["pages_per_sec"] * (1 - tolerance):
+            regressions.append(f"{case}: pages/sec {old['pages_per_sec']:.1f} -> {result['pages_per_sec']:.1f}")
+        if result["peak_rss_mb"] > old["peak_rss_mb"] * (1 + tolerance):
+            regressions.append(f"{case}: peak RSS {old['peak_rss_mb']:.0f} MB -> {result['peak_rss_mb']:.0f} MB")
+        if result["output_bytes"] > old["output_bytes"] * (1 + tolerance):
+            regressions.append(f"{case}: output {old['output_bytes']} B -> {result['output_bytes']} B")
+    return regressions
+
+def print_results(results):
+    phases = ["render", "ocr", "search", "draw", "save"]
+    header = f"{'case':<28}{'pages/s':>10}{'RSS MB':>9}{'out KB':>10}" + "".join(f"{p:>9}" for p in phases)
+    print(header)
+    print("-" * len(header))
+    for case, result in results.items():
+        if result["error"]:
+            print(f"{case:<28}  error: {result['error']}")
+            continue
+        line = (f"{case:<28}{result['pages_per_sec']:>10.1f}{result['peak_rss_mb']:>9.0f}"
+                f"{result['output_bytes'] / 1024:>10.0f}")
+        line += "".join(f"{result['phases'].get(p, 0.0):>9.2f}" for p in phases)
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the watermark modes on a synthetic PDF corpus.")
+    parser.add_argument("--sizes", default="1,100,1000", help="comma-separated page counts")
+    parser.add_argument("--kinds", default="text,scanned,mixed", help="comma-separated corpus kinds")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma-separated modes")
+    parser.add_argument("--corpus-dir", default=os.path.join("/tmp", "pdfwm-bench-corpus"))
+    parser.add_argument("--save-baseline", metavar="FILE", help="write the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(levelname)s - %(message)s")
+    # Measure real OCR work: no cached OCR results between runs.
+    os.environ["OCR_INDEX_PATH"] = ""
+    sizes = [int(size) for size in args.sizes.split(",")]
+    kinds = args.kinds.split(",")
+    modes = args.modes.split(",")
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(unknown)}")
+
+    corpus = generate_corpus(args.corpus_dir, kinds, sizes)
+    results = {}
+    for (kind, pages), path in corpus.items():
+        for mode in modes:
+            case = f"{mode}/{kind}-{pages}"
+            results[case] = run_case(path, mode, pages, args.corpus_dir)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print("REGRESSION", message)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
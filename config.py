@@ -8,3 +8,151 @@ API_HASH = os.getenv("API_HASH", "your_api_hash_here")
 # Path to the Tesseract executable.
 # On a Linux VPS, this is usually installed at /usr/bin/tesseract.
 TESSERACT_CMD = os.getenv("TESSERACT_CMD", "/usr/bin/tesseract")
+
+# Number of worker processes used for CPU-bound PDF work (rendering, OCR, merging).
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", str(os.cpu_count() or 1)))
+
+# Maximum number of PDF jobs allowed to wait for a worker across all chats.
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "50"))
+
+# OCR Cover-Up (option 9): worker processes used to OCR page shards, the number of
+# consecutive pages each worker handles per task, and the rendering resolution.
+# OCR_WORKERS=1 runs OCR serially in the calling process. The jobs running in the bot's
+# worker pool share one budget of OCR_WORKERS processes (see ocr.ocr_process_setup).
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))
+OCR_PAGES_PER_SHARD = int(os.getenv("OCR_PAGES_PER_SHARD", "4"))
+OCR_DPI = int(os.getenv("OCR_DPI", "150"))
+
+# A page whose text layer has fewer usable words than this is OCRed instead of searched directly.
+TEXT_LAYER_MIN_WORDS = int(os.getenv("TEXT_LAYER_MIN_WORDS", "1"))
+# A scanned page, one at least SCANNED_PAGE_IMAGE_COVERAGE covered by images, is also OCRed
+# unless its text-layer words cover at least TEXT_LAYER_MIN_COVERAGE of it: a page number or
+# stamp added after scanning says nothing about the text in the image.
+SCANNED_PAGE_IMAGE_COVERAGE = float(os.getenv("SCANNED_PAGE_IMAGE_COVERAGE", "0.5"))
+TEXT_LAYER_MIN_COVERAGE = float(os.getenv("TEXT_LAYER_MIN_COVERAGE", "0.02"))
+
+# Engine for the standard watermark (locations 1-8): "pymupdf" stamps a shared overlay
+# with PyMuPDF; "legacy" merges a ReportLab overlay with PyPDF2 as the bot originally did.
+STAMP_ENGINE = os.getenv("STAMP_ENGINE", "pymupdf")
+
+# How Cover-Up (locations 9 and 10) hides an area when the request does not say:
+# "cover" paints a white box over it, leaving the content underneath in the file;
+# "redact" removes the text underneath with PDF redactions. REDACT_IMAGES chooses what
+# redaction does to images under the area: "keep" them, "blank" the covered pixels,
+# or "remove" every image touching the area.
+COVER_MODE = os.getenv("COVER_MODE", "cover")
+REDACT_IMAGES = os.getenv("REDACT_IMAGES", "blank")
+
+# Streaming output for very large PDFs: pages are modified in chunks of STREAM_CHUNK_PAGES
+# and written with incremental saves. When the process's resident memory exceeds
+# MAX_MEMORY_MB (0 disables the check) the chunk size is halved. The finished file is
+# rewritten once with OUTPUT_GARBAGE (PyMuPDF garbage level 0-4) and OUTPUT_DEFLATE.
+STREAM_CHUNK_PAGES = int(os.getenv("STREAM_CHUNK_PAGES", "50"))
+MAX_MEMORY_MB = int(os.getenv("MAX_MEMORY_MB", "0"))
+OUTPUT_GARBAGE = int(os.getenv("OUTPUT_GARBAGE", "3"))
+OUTPUT_DEFLATE = os.getenv("OUTPUT_DEFLATE", "1") == "1"
+
+# Output optimization, applied when every output is written: OUTPUT_OBJECT_STREAMS packs
+# objects into compressed object streams. With OUTPUT_IMAGE_QUALITY (1-100; 0 disables)
+# colour and grey images are re-encoded as JPEG at that quality, and images above
+# OUTPUT_IMAGE_DPI (0 keeps their resolution) are downsampled towards it.
+OUTPUT_OBJECT_STREAMS = os.getenv("OUTPUT_OBJECT_STREAMS", "1") == "1"
+OUTPUT_IMAGE_QUALITY = int(os.getenv("OUTPUT_IMAGE_QUALITY", "0"))
+OUTPUT_IMAGE_DPI = int(os.getenv("OUTPUT_IMAGE_DPI", "0"))
+
+# Batch pipeline in the bot: how many files of one batch may be downloading, waiting on
+# the worker pool and uploading at the same time, and how many finished items may queue
+# between stages. Uploads are delivered in submission order when UPLOAD_CONCURRENCY is 1.
+# At most PROCESS_CONCURRENCY + UPLOAD_CONCURRENCY + PIPELINE_QUEUE_SIZE files of a batch
+# are held (downloaded, processed or awaiting upload) at once.
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "3"))
+PROCESS_CONCURRENCY = int(os.getenv("PROCESS_CONCURRENCY", "2"))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "1"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "2"))
+
+# Uploads of all jobs in the bot process: at most UPLOAD_MAX_PARALLEL at once, holding at
+# most UPLOAD_MAX_INFLIGHT_MB together (a larger file is sent on its own). Files above
+# TELEGRAM_MAX_UPLOAD_MB are refused. A FloodWait pauses all uploads for the time Telegram
+# asks; other network errors are retried after UPLOAD_BACKOFF_SECONDS, doubling each time,
+# up to UPLOAD_RETRIES times.
+UPLOAD_MAX_PARALLEL = int(os.getenv("UPLOAD_MAX_PARALLEL", "4"))
+UPLOAD_MAX_INFLIGHT_MB = float(os.getenv("UPLOAD_MAX_INFLIGHT_MB", "100"))
+TELEGRAM_MAX_UPLOAD_MB = float(os.getenv("TELEGRAM_MAX_UPLOAD_MB", "2000"))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "5"))
+UPLOAD_BACKOFF_SECONDS = float(os.getenv("UPLOAD_BACKOFF_SECONDS", "2"))
+
+# Cache of finished outputs, keyed on the Telegram file and the watermark parameters.
+# An empty RESULT_CACHE_DIR disables it.
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "/tmp/pdfwm-result-cache")
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "2048"))
+RESULT_CACHE_MAX_AGE_HOURS = float(os.getenv("RESULT_CACHE_MAX_AGE_HOURS", "72"))
+
+# Persistent per-page OCR results, so Cover-Up reruns on the same document skip tesseract.
+# An empty OCR_INDEX_PATH disables the index.
+OCR_INDEX_PATH = os.getenv("OCR_INDEX_PATH", "/tmp/pdfwm-ocr-index.sqlite3")
+OCR_INDEX_MAX_AGE_DAYS = float(os.getenv("OCR_INDEX_MAX_AGE_DAYS", "30"))
+
+# Sides Cover-Up previews: the first page is rendered so its longer side is at most
+# PREVIEW_MAX_PX pixels (between PREVIEW_MIN_DPI and PREVIEW_MAX_DPI). Annotated grids are
+# cached in PREVIEW_CACHE_DIR; grids unused for PREVIEW_CACHE_MAX_AGE_HOURS are removed, then
+# the least recently used ones beyond PREVIEW_CACHE_MAX_MB. For files of at least PREVIEW_PARTIAL_MIN_MB, only the first
+# PREVIEW_PARTIAL_MB are fetched for the preview when every object of page 1 is in them;
+# grids drawn from such a partial download are not cached.
+PREVIEW_MAX_PX = int(os.getenv("PREVIEW_MAX_PX", "1200"))
+PREVIEW_MIN_DPI = int(os.getenv("PREVIEW_MIN_DPI", "50"))
+PREVIEW_MAX_DPI = int(os.getenv("PREVIEW_MAX_DPI", "150"))
+PREVIEW_CACHE_DIR = os.getenv("PREVIEW_CACHE_DIR", "/tmp/pdfwm-preview-cache")
+PREVIEW_CACHE_MAX_MB = int(os.getenv("PREVIEW_CACHE_MAX_MB", "256"))
+PREVIEW_CACHE_MAX_AGE_HOURS = float(os.getenv("PREVIEW_CACHE_MAX_AGE_HOURS", "72"))
+PREVIEW_PARTIAL_MIN_MB = int(os.getenv("PREVIEW_PARTIAL_MIN_MB", "20"))
+PREVIEW_PARTIAL_MB = int(os.getenv("PREVIEW_PARTIAL_MB", "4"))
+
+# Prometheus-style metrics (phase timings, counters, queue depth, active sessions) served at
+# http://METRICS_HOST:METRICS_PORT/metrics. METRICS_PORT=0 disables the endpoint.
+# With PROFILE_DIR set, every worker job runs under cProfile and its stats are saved there;
+# worker pids are logged so a sampling profiler such as py-spy can be attached instead.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "")
+
+# OCR front-end for Cover-Up. Pages are rendered in grayscale unless OCR_GRAYSCALE=0.
+# With OCR_ADAPTIVE_DPI, the DPI of each page follows the text size found on the previous
+# page of its shard (starting at OCR_DPI) so that a typical word is about
+# OCR_TARGET_TEXT_PX pixels tall, within OCR_MIN_DPI..OCR_MAX_DPI; a page whose text turns
+# out to need OCR_RERUN_FACTOR times more DPI than it got is OCRed again.
+# OCR_PSM, OCR_LANG and OCR_WHITELIST are passed to tesseract (--psm, -l and
+# tessedit_char_whitelist); an empty OCR_PSM or OCR_WHITELIST uses tesseract's default.
+OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "1") == "1"
+OCR_ADAPTIVE_DPI = os.getenv("OCR_ADAPTIVE_DPI", "1") == "1"
+OCR_MIN_DPI = int(os.getenv("OCR_MIN_DPI", "100"))
+OCR_MAX_DPI = int(os.getenv("OCR_MAX_DPI", "300"))
+OCR_TARGET_TEXT_PX = int(os.getenv("OCR_TARGET_TEXT_PX", "24"))
+OCR_RERUN_FACTOR = float(os.getenv("OCR_RERUN_FACTOR", "1.3"))
+OCR_PSM = os.getenv("OCR_PSM", "")
+OCR_LANG = os.getenv("OCR_LANG", "eng")
+OCR_WHITELIST = os.getenv("OCR_WHITELIST", "")
+
+# Conversation sessions are kept in an SQLite file at SESSION_STORE_PATH so they survive a
+# restart (an empty path keeps them in memory); sessions idle for SESSION_TTL_HOURS expire.
+SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", "/tmp/pdfwm-sessions.sqlite3")
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", "24"))
+
+# Finished conversations become jobs in an SQLite queue at JOB_QUEUE_PATH. The bot runs
+# JOB_CONSUMERS consumers; more can be started on the same host with "python main.py --worker".
+# A consumer holds a job for JOB_LEASE_SECONDS at a time, renewing it while it works; the
+# job of a consumer that died is retried, at most JOB_MAX_ATTEMPTS times in total. Idle
+# consumers check for jobs every JOB_POLL_SECONDS. Finished jobs are kept JOB_HISTORY_HOURS.
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "/tmp/pdfwm-jobs.sqlite3")
+JOB_CONSUMERS = int(os.getenv("JOB_CONSUMERS", "4"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+JOB_HISTORY_HOURS = float(os.getenv("JOB_HISTORY_HOURS", "168"))
+
+# Files up to IN_MEMORY_MAX_MB are downloaded, watermarked and uploaded as in-memory
+# buffers; larger files (or files of unknown size) go through a per-job temporary directory.
+IN_MEMORY_MAX_MB = float(os.getenv("IN_MEMORY_MAX_MB", "20"))
+
+# Compiled watermark templates (the one-page PDFs stamped onto pages) are cached per worker
+# process; the TEMPLATE_CACHE_SIZE most recently used ones are kept.
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "64"))
@@ -0,0 +1,50 @@
+import logging
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+def normalized_to_pdf_coords(norm_coord, page_width, page_height):
+    """
+    Converts a normalized coordinate (v,h) on a 0–10 scale into PyMuPDF page coordinates.
+    Here:
+      - v: vertical coordinate (0 at top, 10 at bottom)
+      - h: horizontal coordinate (0 at left, 10 at right)
+    PyMuPDF coordinates have their origin at the top-left, like the grid, so:
+      x = (h/10) * page_width
+      y = (v/10) * page_height
+    """
+    v, h = norm_coord
+    pdf_x = (h / 10) * page_width
+    pdf_y = (v / 10) * page_height
+    logger.debug("Normalized coord %s converted to PDF coords: (%s, %s)", norm_coord, pdf_x, pdf_y)
+    return (pdf_x, pdf_y)
+
+def check_normalized_region(coords):
+    """
+    Raises ValueError unless coords are two (v,h) corners on the 0–10 grid spanning an
+    area, i.e. with different v and different h values. The corners may be in any order.
+    """
+    if len(coords) != 2 or any(len(coord) != 2 for coord in coords):
+        raise ValueError("an area needs two v,h corners")
+    if any(not 0 <= value <= 10 for coord in coords for value in coord):
+        raise ValueError("coordinates must be between 0 and 10")
+    (v1, h1), (v2, h2) = coords
+    if v1 == v2 or h1 == h2:
+        raise ValueError("the corners must differ in both v and h")
+
+def normalized_visible_rect(page, coords):
+    """
+    Returns the rectangle spanned by two normalized (v,h) corners on the page as
+    displayed, i.e. in page.rect coordinates (what get_pixmap's clip expects).
+    """
+    x1, y1 = normalized_to_pdf_coords(coords[0], page.rect.width, page.rect.height)
+    x2, y2 = normalized_to_pdf_coords(coords[1], page.rect.width, page.rect.height)
+    return fitz.Rect(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+def normalized_rect(page, coords):
+    """
+    Returns the rectangle spanned by two normalized (v,h) corners, measured on the page
+    as displayed and converted to the unrotated coordinates drawing and text use.
+    """
+    return normalized_visible_rect(page, coords) * page.derotation_matrix
@@ -0,0 +1,159 @@
+import time
+import json
+import uuid
+import logging
+
+from sqlite_db import connect
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+
+class QueuedJob:
+    """A claimed job: the chat it belongs to and a snapshot of the chat's session."""
+
+    def __init__(self, job_id, chat_id, session, attempts):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.session = session
+        self.attempts = attempts
+
+
+class JobQueue:
+    """
+    FIFO queue of watermarking jobs in an SQLite database, shared by every bot and
+    worker process on the host.
+
+    A consumer claims a job with a lease of lease_seconds and must renew it with
+    heartbeat() while working. If the consumer dies, the lease runs out and the job is
+    handed to the next consumer, so a restart does not drop jobs. A job whose lease has
+    run out max_attempts times is no longer handed out; fail_lost() marks it failed.
+    """
+
+    def __init__(self, db_path, lease_seconds, max_attempts):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with connect(self.db_path) as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, session TEXT NOT NULL,
+                status TEXT NOT NULL, claim_token TEXT, worker TEXT, lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL, finished REAL, error TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    def enqueue(self, chat_id, session):
+        """
+        Adds a job for the chat with a JSON-serialisable session snapshot. Returns the job id.
+        """
+        with connect(self.db_path) as db:
+            cursor = db.execute("INSERT INTO jobs (chat_id, session, status, created) VALUES (?, ?, ?, ?)",
+                                (chat_id, json.dumps(session), JOB_QUEUED, time.time()))
+            return cursor.lastrowid
+
+    def claim(self, worker):
+        """
+        Claims the oldest waiting job, or a running job whose lease has run out and that
+        has attempts left.
+        Returns a QueuedJob, or None when there is nothing to do.
+        """
+        now = time.time()
+        token = uuid.uuid4().hex
+        with connect(self.db_path) as db:
+            # A single UPDATE is atomic, so two consumers can never claim the same job.
+            db.execute("""UPDATE jobs SET status = ?, claim_token = ?, worker = ?, lease_until = ?,
+                          attempts = attempts + 1
+                          WHERE id = (SELECT id FROM jobs
+                                      WHERE status = ? OR (status = ? AND lease_until < ? AND attempts < ?)
+                                      ORDER BY id LIMIT 1)""",
+                       (JOB_RUNNING, token, worker, now + self.lease_seconds, JOB_QUEUED, JOB_RUNNING, now,
+                        self.max_attempts))
+            row = db.execute("SELECT id, chat_id, session, attempts FROM jobs WHERE claim_token = ?",
+                             (token,)).fetchone()
+        if row is None:
+            return None
+        job = QueuedJob(row[0], row[1], json.loads(row[2]), row[3])
+        logger.info("Worker %s claimed job %d for chat %s (attempt %d)", worker, job.id, job.chat_id, job.attempts)
+        return job
+
+    def heartbeat(self, job_id, worker):
+        """
+        Renews the lease of a running job. Returns False if the job is no longer this
+        worker's (it was cancelled, or its lease ran out and another worker took it).
+        """
+        with connect(self.db_path) as db:
+            cursor = db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?",
+                                (time.time() + self.lease_seconds, job_id, worker, JOB_RUNNING))
+            return cursor.rowcount > 0
+
+    def finish(self, job_id, status, error=None):
+        """
+        Records the outcome of a job (JOB_DONE or JOB_FAILED). A cancelled job stays cancelled.
+        """
+        with connect(self.db_path) as db:
+            db.execute("UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ? AND status != ?",
+                       (status, time.time(), error, job_id, JOB_CANCELLED))
+
+    def fail_lost(self):
+        """
+        Marks failed the running jobs whose lease has run out max_attempts times.
+        Returns their sessions: no consumer will clean up their files.
+        """
+        now = time.time()
+        with connect(self.db_path) as db:
+            # Lock before reading, so a job claimed meanwhile is neither returned nor failed.
+            db.execute("BEGIN IMMEDIATE")
+            condition = "status = ? AND lease_until < ? AND attempts >= ?"
+            rows = db.execute(f"SELECT id, session FROM jobs WHERE {condition}",
+                              (JOB_RUNNING, now, self.max_attempts)).fetchall()
+            db.execute(f"UPDATE jobs SET status = ?, finished = ?, error = 'worker lost too often' WHERE {condition}",
+                       (JOB_FAILED, now, JOB_RUNNING, now, self.max_attempts))
+        for job_id, _ in rows:
+            logger.warning("Job %d failed: its worker was lost %d times", job_id, self.max_attempts)
+        return [json.loads(session) for _, session in rows]
+
+    def cancel_chat(self, chat_id):
+        """
+        Cancels the chat's waiting and running jobs. Consumers check is_cancelled()
+        between files. Returns (cancelled, sessions): the number of jobs cancelled and
+        the sessions of those still waiting, whose files no consumer will clean up.
+        """
+        with connect(self.db_path) as db:
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("SELECT status, session FROM jobs WHERE chat_id = ? AND status IN (?, ?)",
+                              (chat_id, JOB_QUEUED, JOB_RUNNING)).fetchall()
+            db.execute("UPDATE jobs SET status = ?, finished = ? WHERE chat_id = ? AND status IN (?, ?)",
+                       (JOB_CANCELLED, time.time(), chat_id, JOB_QUEUED, JOB_RUNNING))
+        return len(rows), [json.loads(session) for status, session in rows if status == JOB_QUEUED]
+
+    def is_cancelled(self, job_id):
+        with connect(self.db_path) as db:
+            row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is None or row[0] == JOB_CANCELLED
+
+    def position(self, job_id):
+        """
+        Returns the number of waiting jobs ahead of a waiting job, or None if it is not waiting.
+        """
+        with connect(self.db_path) as db:
+            row = db.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[0] != JOB_QUEUED:
+                return None
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE status = ? AND id < ?",
+                              (JOB_QUEUED, job_id)).fetchone()[0]
+
+    def depth(self):
+        with connect(self.db_path) as db:
+            return db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (JOB_QUEUED,)).fetchone()[0]
+
+    def purge(self, max_age_seconds):
+        """
+        Deletes finished, failed and cancelled jobs older than max_age_seconds.
+        """
+        with connect(self.db_path) as db:
+            db.execute("DELETE FROM jobs WHERE status IN (?, ?, ?) AND finished < ?",
+                       (JOB_DONE, JOB_FAILED, JOB_CANCELLED, time.time() - max_age_seconds))
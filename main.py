@@ -1,20 +1,44 @@
 import os
+import sys
+import time
+import shutil
+import socket
+import asyncio
 import tempfile
-from io import BytesIO
 import logging
+import weakref
+from io import BytesIO
 
-from pyrogram import Client, filters
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.colors import red, black, white
 
-import pytesseract
-from PIL import Image, ImageDraw, ImageFont
-import fitz  # PyMuPDF
-
-from config import BOT_TOKEN, API_ID, API_HASH, TESSERACT_CMD
-pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+from config import (
+    BOT_TOKEN, API_ID, API_HASH, WORKER_COUNT, MAX_QUEUE_DEPTH,
+    DOWNLOAD_CONCURRENCY, PROCESS_CONCURRENCY, UPLOAD_CONCURRENCY, PIPELINE_QUEUE_SIZE,
+    RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB, RESULT_CACHE_MAX_AGE_HOURS,
+    PREVIEW_CACHE_DIR, PREVIEW_CACHE_MAX_MB, PREVIEW_CACHE_MAX_AGE_HOURS, PREVIEW_PARTIAL_MIN_MB,
+    PREVIEW_PARTIAL_MB, METRICS_HOST, METRICS_PORT,
+    SESSION_STORE_PATH, SESSION_TTL_HOURS, JOB_QUEUE_PATH, JOB_CONSUMERS, JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS, JOB_POLL_SECONDS, JOB_HISTORY_HOURS, IN_MEMORY_MAX_MB, UPLOAD_MAX_PARALLEL,
+    UPLOAD_MAX_INFLIGHT_MB, TELEGRAM_MAX_UPLOAD_MB, UPLOAD_RETRIES, UPLOAD_BACKOFF_SECONDS
+)
+from metrics import (
+    PHASE_DOWNLOAD, PHASE_UPLOAD, COUNTER_PAGES, COUNTER_BYTES_IN, COUNTER_BYTES_OUT,
+    timed, count, register_gauge, format_phases, start_metrics_server
+)
+from watermark import COLOR_MAPPING, create_watermarked_pdf
+from ocr import format_ocr_report, ocr_process_setup
+from preview import (
+    annotate_first_page_image, render_cover_preview, find_cached_grid, grid_cache_path, prune_grid_cache
+)
+from worker_pool import WorkerPool, QueueFullError
+from pipeline import STAGE_DOWNLOAD, STAGE_PROCESS, run_pipeline
+from result_cache import ResultCache
+from session_store import new_session, open_session_store
+from job_queue import JOB_DONE, JOB_FAILED, JobQueue
+from workspace import Workspace, safe_file_name, output_name
+from uploads import UploadScheduler
+from geometry import check_normalized_region
 
 # Set up logging configuration
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
@@ -24,86 +48,131 @@ logger = logging.getLogger(__name__)
 WAITING_FOR_PDF = "WAITING_FOR_PDF"
 WAITING_FOR_LOCATION = "WAITING_FOR_LOCATION"
 WAITING_FOR_FIND_TEXT = "WAITING_FOR_FIND_TEXT"  # For OCR Cover-Up (option 9)
+WAITING_FOR_FIND_REGION = "WAITING_FOR_FIND_REGION"
 WAITING_FOR_SIDE_TOP_LEFT = "WAITING_FOR_SIDE_TOP_LEFT"  # For Sides Cover-Up (option 10)
 WAITING_FOR_SIDE_BOTTOM_RIGHT = "WAITING_FOR_SIDE_BOTTOM_RIGHT"
+WAITING_FOR_SIDE_CONFIRM = "WAITING_FOR_SIDE_CONFIRM"
+WAITING_FOR_COVER_MODE = "WAITING_FOR_COVER_MODE"  # For options 9 and 10
 WAITING_FOR_WATERMARK_TEXT = "WAITING_FOR_WATERMARK_TEXT"
 WAITING_FOR_TEXT_SIZE = "WAITING_FOR_TEXT_SIZE"
 WAITING_FOR_COLOR = "WAITING_FOR_COLOR"
 
-# Global dictionary to store conversation data per chat.
-user_data = {}
+# Answers to the cover mode question: (cover_mode, redact_images).
+COVER_MODE_CHOICES = {"1": ("cover", None), "2": ("redact", "keep"), "3": ("redact", "blank"),
+                      "4": ("redact", "remove")}
+COVER_MODE_PROMPT = ("How should the area be hidden? Send a number:\n"
+                     "1. White box (the text underneath stays in the file)\n"
+                     "2. Redact text, keep images\n"
+                     "3. Redact text and blank images under the area\n"
+                     "4. Redact text and remove images touching the area")
+
+# Conversation data per chat.
+sessions = open_session_store(SESSION_STORE_PATH, SESSION_TTL_HOURS * 3600)
+
+# Watermarking jobs waiting for a consumer, shared by all bot and worker processes on the host.
+job_queue = JobQueue(JOB_QUEUE_PATH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+
+# Process pool for CPU-bound PDF work, shared by all chats.
+worker_pool = WorkerPool(WORKER_COUNT, MAX_QUEUE_DEPTH, process_setup=ocr_process_setup)
+
+# Uploads of all jobs in this process, kept within Telegram's limits.
+upload_scheduler = UploadScheduler(
+    UPLOAD_MAX_PARALLEL, UPLOAD_MAX_INFLIGHT_MB * 1024 * 1024, TELEGRAM_MAX_UPLOAD_MB * 1024 * 1024,
+    UPLOAD_RETRIES, UPLOAD_BACKOFF_SECONDS
+)
 
-def normalized_to_pdf_coords(norm_coord, page_width, page_height):
+# Cache of finished outputs; None when disabled.
+result_cache = ResultCache(
+    RESULT_CACHE_DIR, RESULT_CACHE_MAX_MB * 1024 * 1024, RESULT_CACHE_MAX_AGE_HOURS * 3600
+) if RESULT_CACHE_DIR else None
+
+# Held around each read-modify-write of a chat's session: pyrogram runs handlers
+# concurrently and the store hands out copies, so concurrent updates would be lost.
+session_locks = weakref.WeakValueDictionary()  # chat_id -> asyncio.Lock, while in use
+
+def session_lock(chat_id):
+    lock = session_locks.get(chat_id)
+    if lock is None:
+        lock = session_locks[chat_id] = asyncio.Lock()
+    return lock
+
+def session_workspace(session):
     """
-    Converts a normalized coordinate (v,h) on a 0–10 scale into actual PDF coordinates.
-    Here:
-      - v: vertical coordinate (0 at top, 10 at bottom)
-      - h: horizontal coordinate (0 at left, 10 at right)
-    PDF coordinates have origin at bottom-left, so:
-      PDF_x = (h/10) * page_width
-      PDF_y = page_height - ((v/10) * page_height)
+    Returns the session's private directory, creating it on first use. Files kept for
+    the whole session (the first PDF, previews) live here.
     """
-    v, h = norm_coord
-    pdf_x = (h / 10) * page_width
-    pdf_y = page_height - ((v / 10) * page_height)
-    logger.debug("Normalized coord %s converted to PDF coords: (%s, %s)", norm_coord, pdf_x, pdf_y)
-    return (pdf_x, pdf_y)
+    if not session.get("workspace"):
+        session["workspace"] = tempfile.mkdtemp(prefix="pdfwm-session-")
+    return session["workspace"]
 
-def annotate_first_page_image(pdf_path, dpi=150):
+def discard_session_files(session):
+    if session and session.get("workspace"):
+        shutil.rmtree(session["workspace"], ignore_errors=True)
+        session["workspace"] = None
+
+async def fetch_first_pdf(client: Client, chat_id: int, session, partial_ok=True):
     """
-    Opens the PDF's first page using PyMuPDF, renders it as an image,
-    and draws a blue border with tick marks and normalized coordinate labels (0–10)
-    along the top (x axis) and left (y axis) edges.
-    Returns the path of the annotated image.
+    Returns a local path to the session's first PDF for previews.
+    The full download is kept in the session workspace, so processing does not fetch it
+    again. For large files, when partial_ok, only the first PREVIEW_PARTIAL_MB are fetched.
     """
-    logger.info("Annotating first page of PDF: %s", pdf_path)
-    doc = fitz.open(pdf_path)
-    page = doc[0]
-    scale = dpi / 72
-    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale))
-    image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    
-    draw = ImageDraw.Draw(image)
-    try:
-        font = ImageFont.truetype("arial.ttf", 12)
-    except Exception:
-        font = ImageFont.load_default()
-    
-    img_width, img_height = image.size
+    pdf_info = session["pdfs"][0]
+    if pdf_info.get("local_path"):
+        return pdf_info["local_path"]
+    workspace = session_workspace(session)
+    if partial_ok and (pdf_info.get("file_size") or 0) >= PREVIEW_PARTIAL_MIN_MB * 1024 * 1024:
+        partial_path = os.path.join(workspace, "preview-partial.pdf")
+        if not os.path.exists(partial_path):
+            logger.info("Fetching first %d MB of %s for chat %s", PREVIEW_PARTIAL_MB, pdf_info["file_name"], chat_id)
+            with open(partial_path, "wb") as f:
+                async for chunk in client.stream_media(pdf_info["file_id"], limit=PREVIEW_PARTIAL_MB):
+                    f.write(chunk)
+        return partial_path
+    local_path = os.path.join(workspace, safe_file_name(pdf_info["file_name"]))
+    logger.info("Downloading PDF %s for chat %s", pdf_info["file_name"], chat_id)
+    with timed(PHASE_DOWNLOAD):
+        await client.download_media(pdf_info["file_id"], file_name=local_path)
+    count(COUNTER_BYTES_IN, os.path.getsize(local_path))
+    pdf_info["local_path"] = local_path
+    return local_path
 
-    # Draw blue border.
-    draw.rectangle([0, 0, img_width-1, img_height-1], outline="blue", width=2)
-    
-    # Draw tick marks along the top edge (horizontal scale 0 to 10).
-    for i in range(11):
-        x = (i/10) * img_width
-        draw.line([(x, 0), (x, 10)], fill="blue", width=2)
-        draw.text((x+2, 12), f"{i}", fill="blue", font=font)
-    
-    # Draw tick marks along the left edge (vertical scale 0 to 10).
-    for i in range(11):
-        y = (i/10) * img_height
-        draw.line([(0, y), (10, y)], fill="blue", width=2)
-        draw.text((12, y-6), f"{i}", fill="blue", font=font)
-    
-    annotated_path = pdf_path.replace(".pdf", "_annotated.jpg")
-    image.save(annotated_path)
-    doc.close()
-    logger.info("Annotated image saved: %s", annotated_path)
-    return annotated_path
+async def render_first_page(client: Client, chat_id: int, session, fn, *args, partial_kwargs=None, **kwargs):
+    """
+    Runs fn(pdf_path, *args, **kwargs) in the worker pool on the first PDF. On a partial
+    download fn is called with partial=True and partial_kwargs overriding kwargs, and
+    raises if page 1 is not all there; the whole file is then downloaded and fn retried.
+    """
+    source = await fetch_first_pdf(client, chat_id, session)
+    if source != session["pdfs"][0].get("local_path"):
+        try:
+            return await worker_pool.submit(chat_id, fn, source, *args,
+                                            **{**kwargs, **(partial_kwargs or {}), "partial": True})
+        except Exception as e:
+            logger.info("Partial PDF not renderable for chat %s (%s); downloading it fully", chat_id, e)
+        source = await fetch_first_pdf(client, chat_id, session, partial_ok=False)
+    return await worker_pool.submit(chat_id, fn, source, *args, **kwargs)
 
-async def send_first_page_image(client: Client, chat_id: int):
+async def send_first_page_image(client: Client, chat_id: int, session):
     """
-    Downloads the first PDF from the user's list, creates an annotated image of its first page
-    with a normalized grid from 0 to 10, and sends it to the user.
+    Sends an annotated image of the first PDF's first page with a normalized grid from
+    0 to 10. Grids are cached per file and DPI, so a file sent again needs no download;
+    grids drawn from a partial download are not cached.
     """
     try:
         logger.info("Preparing annotated image for chat %s", chat_id)
-        pdf_info = user_data[chat_id]["pdfs"][0]
-        temp_pdf_path = os.path.join(tempfile.gettempdir(), pdf_info["file_name"])
-        logger.info("Downloading PDF %s for chat %s", pdf_info["file_name"], chat_id)
-        await client.download_media(pdf_info["file_id"], file_name=temp_pdf_path)
-        annotated_path = annotate_first_page_image(temp_pdf_path, dpi=150)
+        file_unique_id = session["pdfs"][0].get("file_unique_id")
+        annotated_path = find_cached_grid(PREVIEW_CACHE_DIR, file_unique_id)
+        if annotated_path:
+            logger.info("Using cached grid image for chat %s", chat_id)
+        else:
+            workspace_path = os.path.join(session_workspace(session), "grid-{dpi}.jpg")
+            if PREVIEW_CACHE_DIR and file_unique_id:
+                output_path = grid_cache_path(PREVIEW_CACHE_DIR, file_unique_id, "{dpi}")
+            else:
+                output_path = workspace_path
+            annotated_path = await render_first_page(
+                client, chat_id, session, annotate_first_page_image, output_path=output_path,
+                partial_kwargs={"output_path": workspace_path})
         await client.send_photo(
             chat_id,
             photo=annotated_path,
@@ -114,225 +183,335 @@ async def send_first_page_image(client: Client, chat_id: int):
                      "• LEFT TOP (e.g., 2,3)   [v=2, h=3]\n"
                      "• RIGHT BOTTOM (e.g., 8,7)   [v=8, h=7]")
         )
-        os.remove(temp_pdf_path)
-        os.remove(annotated_path)
-        logger.info("Temporary files removed for chat %s", chat_id)
+    except asyncio.CancelledError:
+        logger.info("Annotated image for chat %s cancelled", chat_id)
     except Exception as e:
         logger.error("Error sending annotated image for chat %s: %s", chat_id, e)
         await client.send_message(chat_id, f"Error sending annotated image: {e}")
 
-def create_watermarked_pdf(input_pdf_path, watermark_text, text_size, color, location, find_text=None, cover_coords=None):
+async def send_cover_preview(client: Client, chat_id: int, session):
     """
-    For locations 1-8: standard watermark.
-    For location 9 (OCR Cover-Up): uses PyMuPDF + pytesseract to cover found text.
-    For location 10 (Sides Cover-Up): uses two normalized coordinates (v,h on 0–10 scale)
-    to determine a rectangular region on each page, covers it with white,
-    and places the watermark text centered in that region.
+    Sends page 1 with the chosen Sides Cover-Up rectangle drawn on it, so the user can
+    confirm it before the whole batch is processed.
     """
-    logger.info("Creating watermarked PDF for: %s", input_pdf_path)
-    if location == 9 and find_text:
-        logger.info("Using OCR Cover-Up for text: %s", find_text)
-        doc = fitz.open(input_pdf_path)
-        dpi = 150
-        scale = dpi / 72
-        for page in doc:
-            page_width = page.rect.width
-            page_height = page.rect.height
-            mat = fitz.Matrix(scale, scale)
-            pix = page.get_pixmap(matrix=mat)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            ocr_data = pytesseract.image_to_data(img, output_type=pytesseract.Output.DICT)
-            n_boxes = len(ocr_data["text"])
-            for i in range(n_boxes):
-                word = ocr_data["text"][i].strip()
-                if word.lower() == find_text.lower():
-                    left = ocr_data["left"][i]
-                    top = ocr_data["top"][i]
-                    width = ocr_data["width"][i]
-                    height = ocr_data["height"][i]
-                    pdf_x = left / scale
-                    pdf_width = width / scale
-                    pdf_height = height / scale
-                    pdf_y = page_height - ((top + height) / scale)
-                    rect = fitz.Rect(pdf_x, pdf_y, pdf_x + pdf_width, pdf_y + pdf_height)
-                    page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
-                    text_x = pdf_x
-                    text_y = pdf_y + pdf_height + 2
-                    wm_color = (color.red, color.green, color.blue)
-                    page.insert_text((text_x, text_y), watermark_text, fontsize=text_size, color=wm_color)
-                    logger.debug("Applied OCR watermark on word '%s' at rect %s", word, rect)
-        output_pdf_path = input_pdf_path.replace(".pdf", "_watermarked.pdf")
-        doc.save(output_pdf_path)
-        logger.info("OCR watermarked PDF saved: %s", output_pdf_path)
-        return output_pdf_path
-
-    elif location == 10 and cover_coords and len(cover_coords) == 2:
-        logger.info("Using Sides Cover-Up with coordinates: %s", cover_coords)
-        # Sides Cover-Up applied to every page.
-        doc = fitz.open(input_pdf_path)
-        for page in doc:
-            page_width = page.rect.width
-            page_height = page.rect.height
-            left_top_pdf = normalized_to_pdf_coords(cover_coords[0], page_width, page_height)
-            right_bottom_pdf = normalized_to_pdf_coords(cover_coords[1], page_width, page_height)
-            x1, y1 = left_top_pdf
-            x2, y2 = right_bottom_pdf
-            rect = fitz.Rect(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
-            page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
-            center_x = (rect.x0 + rect.x1) / 2
-            center_y = (rect.y0 + rect.y1) / 2
-            wm_color = (color.red, color.green, color.blue)
-            text_box = fitz.Rect(center_x - 100, center_y - text_size, center_x + 100, center_y + text_size)
-            page.insert_textbox(text_box, watermark_text, fontsize=text_size, color=wm_color, align=1)
-            logger.debug("Applied Sides Cover-Up on page with rect: %s", rect)
-        output_pdf_path = input_pdf_path.replace(".pdf", "_watermarked.pdf")
-        doc.save(output_pdf_path)
-        logger.info("Sides watermarked PDF saved: %s", output_pdf_path)
-        return output_pdf_path
+    try:
+        output_path = os.path.join(session_workspace(session), "cover-preview.jpg")
+        preview_path = await render_first_page(
+            client, chat_id, session, render_cover_preview, session["side_coords"], output_path)
+        await client.send_photo(
+            chat_id,
+            photo=preview_path,
+            caption=("The red area will be covered on every page.\n"
+                     "Reply OK to continue, or send a new LEFT TOP coordinate (v,h) to redraw it.")
+        )
+    except asyncio.CancelledError:
+        logger.info("Cover preview for chat %s cancelled", chat_id)
+    except Exception as e:
+        logger.error("Error sending cover preview for chat %s: %s", chat_id, e)
+        await client.send_message(chat_id, f"Error sending cover preview: {e}. Reply OK to continue anyway.")
 
-    else:
-        logger.info("Using standard watermarking method.")
-        # Standard watermarking using ReportLab and PyPDF2.
-        reader = PdfReader(input_pdf_path)
-        first_page = reader.pages[0]
-        page_width = float(first_page.mediabox.width)
-        page_height = float(first_page.mediabox.height)
-        watermark_stream = BytesIO()
-        c = canvas.Canvas(watermark_stream, pagesize=(page_width, page_height))
-        c.setFont("Helvetica", text_size)
-        c.setFillColor(color)
-        margin = 10
-
-        x, y = 0, 0
-        rotation = 0
-        if location == 1:
-            x = page_width - margin - 100
-            y = page_height - margin - text_size
-        elif location == 2:
-            x = (page_width / 2) - 50
-            y = page_height - margin - text_size
-        elif location == 3:
-            x = margin
-            y = page_height - margin - text_size
-        elif location == 4:
-            x = (page_width / 2) - 50
-            y = (page_height / 2) - (text_size / 2)
-        elif location == 5:
-            x = (page_width / 2) - 50
-            y = (page_height / 2) - (text_size / 2)
-            rotation = 45
-        elif location == 6:
-            x = page_width - margin - 100
-            y = margin
-        elif location == 7:
-            x = (page_width / 2) - 50
-            y = margin
-        elif location == 8:
-            x = margin
-            y = margin
-
-        if rotation:
-            c.saveState()
-            c.translate(x, y)
-            c.rotate(rotation)
-            c.drawString(0, 0, watermark_text)
-            c.restoreState()
-        else:
-            c.drawString(x, y, watermark_text)
-        c.save()
-        watermark_stream.seek(0)
-        watermark_reader = PdfReader(watermark_stream)
-        watermark_page = watermark_reader.pages[0]
-        writer = PdfWriter()
-        for page in reader.pages:
-            page.merge_page(watermark_page)
-            writer.add_page(page)
-        output_pdf_path = input_pdf_path.replace(".pdf", "_watermarked.pdf")
-        with open(output_pdf_path, "wb") as out_file:
-            writer.write(out_file)
-        logger.info("Standard watermarked PDF saved: %s", output_pdf_path)
-        return output_pdf_path
-
-async def process_pdfs_handler(client: Client, chat_id: int):
-    data = user_data.get(chat_id)
-    if not data:
-        logger.warning("No data found for chat %s", chat_id)
-        return
+async def process_pdfs_handler(client: Client, chat_id: int, data, job_id):
+    """
+    Watermarks and sends the PDFs of one finished conversation (data), queued as job_id.
+    """
     pdfs = data.get("pdfs", [])
     location = data.get("location")
     watermark_text = data.get("watermark_text")
     text_size = data.get("text_size")
     color_name = data.get("color")
-    color_mapping = {"red": red, "black": black, "white": white}
-    watermark_color = color_mapping.get(color_name, black)
+    watermark_color = COLOR_MAPPING.get(color_name, COLOR_MAPPING["black"])
     
     find_text = data.get("find_text") if location == 9 else None
+    find_region = data.get("find_region") if location == 9 else None
     cover_coords = data.get("side_coords") if location == 10 else None
+    cover_mode = data.get("cover_mode") if location in (9, 10) else None
+    redact_images = data.get("redact_images") if cover_mode == "redact" else None
+    cache_params = {
+        "location": location, "watermark_text": watermark_text, "text_size": text_size,
+        "color": color_name, "find_text": find_text, "side_coords": cover_coords, "find_region": find_region,
+        "cover_mode": cover_mode, "redact_images": redact_images,
+    }
+    # Files of one batch download concurrently and may share a name: each gets its own
+    # directory in the job's workspace, which is removed when the job ends.
+    workspace = Workspace()
 
-    logger.info("Processing %d PDF(s) for chat %s", len(pdfs), chat_id)
-    for pdf_info in pdfs:
-        file_id = pdf_info["file_id"]
-        file_name = pdf_info["file_name"]
-        try:
-            temp_pdf_path = os.path.join(tempfile.gettempdir(), file_name)
-            logger.info("Downloading PDF %s for chat %s", file_name, chat_id)
-            await client.download_media(file_id, file_name=temp_pdf_path)
-        except Exception as e:
-            logger.error("Error downloading %s for chat %s: %s", file_name, chat_id, e)
-            await client.send_message(chat_id, f"Error downloading {file_name}: {e}")
-            continue
+    async def download(item):
+        file_name = safe_file_name(item.payload["file_name"])
+        item.cache_key = None
+        item.cached = None
+        # Per-file timings for the job summary, as {phase: (seconds, calls)}.
+        item.phases = {}
+        item.pages = 0
+        item.ocr_report = ""
+        item.input_bytes = 0
+        # Files up to IN_MEMORY_MAX_MB are processed as bytes and never touch the disk.
+        item.input_data = None
+        item.output_data = None
+        if result_cache is not None and item.payload.get("file_unique_id"):
+            item.cache_key = ResultCache.make_key(item.payload["file_unique_id"], cache_params)
+            item.cached = await asyncio.to_thread(result_cache.get, item.cache_key)
+            if item.cached is not None:
+                logger.info("Using cached result for %s in chat %s", file_name, chat_id)
+                return
+        if item.payload.get("local_path") and os.path.exists(item.payload["local_path"]):
+            # Already downloaded for the Sides Cover-Up preview.
+            item.input_path = item.payload["local_path"]
+            item.input_bytes = os.path.getsize(item.input_path)
+            return
+        file_size = item.payload.get("file_size") or 0
+        in_memory = 0 < file_size <= IN_MEMORY_MAX_MB * 1024 * 1024
+        logger.info("Downloading PDF %s for chat %s%s", file_name, chat_id, " into memory" if in_memory else "")
+        started = time.perf_counter()
+        with timed(PHASE_DOWNLOAD):
+            if in_memory:
+                buffer = await client.download_media(item.payload["file_id"], in_memory=True)
+                item.input_data = buffer.getvalue()
+                received = len(item.input_data)
+            else:
+                item.input_path = workspace.file_path(item.index, file_name)
+                await client.download_media(item.payload["file_id"], file_name=item.input_path)
+                received = os.path.getsize(item.input_path)
+        item.phases[PHASE_DOWNLOAD] = (time.perf_counter() - started, 1)
+        item.input_bytes = received
+        count(COUNTER_BYTES_IN, received)
 
-        watermarked_pdf_path = create_watermarked_pdf(
-            temp_pdf_path, watermark_text, text_size, watermark_color,
-            location, find_text=find_text, cover_coords=cover_coords
+    async def process(item):
+        file_name = safe_file_name(item.payload["file_name"])
+        if await asyncio.to_thread(job_queue.is_cancelled, job_id):
+            logger.info("Session for chat %s was reset; stopping batch", chat_id)
+            raise asyncio.CancelledError()
+        if item.cached is not None:
+            return
+        if item.input_data is not None:
+            # OCR shards get the PDF through a file in the workspace, not a copy each.
+            source, output_pdf_path = item.input_data, None
+        else:
+            source = item.input_path
+            output_pdf_path = workspace.file_path(item.index, output_name(safe_file_name(file_name)))
+        job = worker_pool.submit(
+            chat_id, create_watermarked_pdf,
+            source, watermark_text, text_size, watermark_color,
+            location, find_text=find_text, cover_coords=cover_coords, ocr_region=find_region,
+            cover_mode=cover_mode, redact_images=redact_images, output_pdf_path=output_pdf_path,
+            work_dir=workspace.item_dir(item.index)
         )
+        if job.position:
+            await client.send_message(chat_id, f"{file_name}: you are #{job.position} in queue.")
+        try:
+            result = await job
+        finally:
+            # The input is not needed any more; do not hold it in memory beside the output.
+            item.input_data = None
+        if isinstance(result, bytes):
+            item.output_data = result
+        else:
+            item.output_path = result
+        if job.metrics:
+            item.phases.update(job.metrics["phases"])
+            item.pages = job.metrics["counters"].get(COUNTER_PAGES, 0)
+            item.ocr_report = format_ocr_report(job.metrics)
+
+    async def upload(item):
+        name = output_name(safe_file_name(item.payload["file_name"]))
+        if item.cached is not None:
+            if item.cached.telegram_file_id:
+                try:
+                    await upload_scheduler.send(
+                        lambda: client.send_document(chat_id, item.cached.telegram_file_id), 0, name)
+                    return
+                except Exception as e:
+                    logger.warning("Re-sending cached file_id failed for chat %s: %s", chat_id, e)
+            item.output_path = item.cached.path
+
+        def document():
+            # A fresh buffer for every attempt, as a failed send leaves it partly read.
+            if item.output_data is None:
+                return item.output_path
+            buffer = BytesIO(item.output_data)
+            buffer.name = name
+            return buffer
+
+        if item.output_data is not None:
+            output_bytes = len(item.output_data)
+        else:
+            output_bytes = os.path.getsize(item.output_path)
+        logger.info("Sending watermarked PDF %s for chat %s", name, chat_id)
+        sent, upload_seconds = await upload_scheduler.send(
+            lambda: client.send_document(chat_id, document()), output_bytes, name)
+        item.phases[PHASE_UPLOAD] = (upload_seconds, 1)
+        count(COUNTER_BYTES_OUT, output_bytes)
+        ratio = f" ({output_bytes / item.input_bytes:.0%} of {item.input_bytes} bytes in)" if item.input_bytes else ""
+        logger.info("Job summary for %s in chat %s: %d page(s), %d bytes out%s, uploaded in %.2fs; %s%s",
+                    item.payload["file_name"], chat_id, item.pages, output_bytes, ratio, upload_seconds,
+                    format_phases(item.phases), f"; {item.ocr_report}" if item.ocr_report else "")
+        if item.cache_key is None:
+            return
         try:
-            logger.info("Sending watermarked PDF %s for chat %s", watermarked_pdf_path, chat_id)
-            await client.send_document(chat_id, watermarked_pdf_path)
+            if item.cached is None:
+                output = item.output_data if item.output_data is not None else item.output_path
+                await asyncio.to_thread(result_cache.put, item.cache_key, output)
+            if sent and sent.document:
+                await asyncio.to_thread(result_cache.set_telegram_file_id, item.cache_key, sent.document.file_id)
         except Exception as e:
-            logger.error("Error sending watermarked file %s for chat %s: %s", file_name, chat_id, e)
-            await client.send_message(chat_id, f"Error sending watermarked file {file_name}: {e}")
+            logger.warning("Could not cache result for chat %s: %s", chat_id, e)
+
+    async def report_error(item):
+        file_name = safe_file_name(item.payload["file_name"])
+        logger.error("Error in %s of %s for chat %s: %s", item.failed_stage, file_name, chat_id, item.error)
+        if isinstance(item.error, QueueFullError):
+            await client.send_message(chat_id, f"The bot is busy right now, {file_name} was not processed. "
+                                               "Please try again in a few minutes.")
+        elif item.failed_stage == STAGE_DOWNLOAD:
+            await client.send_message(chat_id, f"Error downloading {file_name}: {item.error}")
+        elif item.failed_stage == STAGE_PROCESS:
+            await client.send_message(chat_id, f"Error watermarking {file_name}: {item.error}")
+        else:
+            await client.send_message(chat_id, f"Error sending watermarked file {file_name}: {item.error}")
+
+    async def cleanup(item):
+        # Free each file's disk space and buffers as soon as it is done, not at the end of the batch.
+        workspace.remove_item(item.index)
+        item.input_data = item.output_data = None
+        logger.info("Removed temporary files for %s", item.payload["file_name"])
+
+    logger.info("Processing %d PDF(s) for chat %s", len(pdfs), chat_id)
+    try:
+        with workspace:
+            await run_pipeline(
+                pdfs, download, process, upload, on_error=report_error, cleanup=cleanup,
+                download_concurrency=DOWNLOAD_CONCURRENCY, process_concurrency=PROCESS_CONCURRENCY,
+                upload_concurrency=UPLOAD_CONCURRENCY, queue_size=PIPELINE_QUEUE_SIZE
+            )
+    except asyncio.CancelledError:
+        if not await asyncio.to_thread(job_queue.is_cancelled, job_id):
+            # Shutting down: leave the job to be retried when its lease runs out.
+            raise
+        logger.info("Processing cancelled for chat %s", chat_id)
+
+async def keep_job_lease(job, worker):
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
         try:
-            os.remove(temp_pdf_path)
-            os.remove(watermarked_pdf_path)
-            logger.info("Removed temporary files for %s", file_name)
+            if not await asyncio.to_thread(job_queue.heartbeat, job.id, worker):
+                return
         except Exception as e:
-            logger.warning("Error removing temporary files for %s: %s", file_name, e)
+            # The next heartbeat may get through before the lease runs out.
+            logger.warning("Could not renew the lease of job %d: %s", job.id, e)
+
+async def consume_jobs(client: Client, worker):
+    """
+    Takes jobs from the job queue and processes them, one at a time, until cancelled.
+    """
+    while True:
+        try:
+            job = await asyncio.to_thread(job_queue.claim, worker)
+        except Exception:
+            # E.g. the queue database is locked for too long; the consumer must keep going.
+            logger.exception("Worker %s could not claim a job", worker)
+            job = None
+        if job is None:
+            await asyncio.sleep(JOB_POLL_SECONDS)
+            continue
+        try:
+            await run_job(client, job, worker)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Worker %s could not finish job %d", worker, job.id)
+        discard_session_files(job.session)
+
+async def run_job(client: Client, job, worker):
+    """
+    Processes a claimed job under a renewed lease and records its outcome; the chat is
+    told when it failed.
+    """
+    lease = asyncio.create_task(keep_job_lease(job, worker))
+    try:
+        await process_pdfs_handler(client, job.chat_id, job.session, job.id)
+        await asyncio.to_thread(job_queue.finish, job.id, JOB_DONE)
+        logger.info("PDF processing completed for chat %s", job.chat_id)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.exception("Job %d for chat %s failed", job.id, job.chat_id)
+        await asyncio.to_thread(job_queue.finish, job.id, JOB_FAILED, str(e))
+        try:
+            await client.send_message(job.chat_id, f"Error processing your PDFs: {e}")
+        except Exception as send_error:
+            # E.g. the user has blocked the bot.
+            logger.warning("Could not tell chat %s about the failure: %s", job.chat_id, send_error)
+    finally:
+        lease.cancel()
+
+async def expire_sessions():
+    """
+    Drops abandoned sessions and jobs whose workers kept getting lost with their files,
+    old job records and stale preview grids, once a minute.
+    """
+    while True:
+        for session in await asyncio.to_thread(sessions.expire):
+            discard_session_files(session)
+        for session in await asyncio.to_thread(job_queue.fail_lost):
+            discard_session_files(session)
+        await asyncio.to_thread(job_queue.purge, JOB_HISTORY_HOURS * 3600)
+        if PREVIEW_CACHE_DIR:
+            await asyncio.to_thread(prune_grid_cache, PREVIEW_CACHE_DIR, PREVIEW_CACHE_MAX_MB * 1024 * 1024,
+                                    PREVIEW_CACHE_MAX_AGE_HOURS * 3600)
+        await asyncio.sleep(60)
 
 app = Client("pdf_watermark_bot", bot_token=BOT_TOKEN, api_id=API_ID, api_hash=API_HASH)
 
 @app.on_message(filters.command("pdfwatermark"))
 async def start_pdfwatermark_handler(client: Client, message: Message):
     chat_id = message.chat.id
-    user_data[chat_id] = {"state": WAITING_FOR_PDF, "pdfs": []}
+    # Starting over replaces the chat's earlier request, also one already submitted.
+    cancelled, waiting_sessions = await asyncio.to_thread(job_queue.cancel_chat, chat_id)
+    for session in waiting_sessions:
+        discard_session_files(session)
+    worker_pool.cancel_chat(chat_id)
+    async with session_lock(chat_id):
+        discard_session_files(await asyncio.to_thread(sessions.get, chat_id))
+        await asyncio.to_thread(sessions.put, chat_id, new_session(state=WAITING_FOR_PDF, pdfs=[]))
     logger.info("Chat %s started PDF watermarking.", chat_id)
+    if cancelled:
+        logger.info("Cancelled %d submitted job(s) of chat %s", cancelled, chat_id)
+        await message.reply_text("Your previous watermarking request was cancelled; "
+                                 "files it had not sent yet will not be delivered.")
     await message.reply_text("Please send all PDF files now.")
 
 @app.on_message(filters.document)
 async def receive_pdf_handler(client: Client, message: Message):
     chat_id = message.chat.id
-    if chat_id not in user_data or user_data[chat_id].get("state") != WAITING_FOR_PDF:
-        return
-    document = message.document
-    if document.mime_type != "application/pdf":
-        logger.info("Received non-PDF file in chat %s", chat_id)
-        await message.reply_text("This is not a PDF file. Please send a PDF.")
-        return
-    user_data[chat_id]["pdfs"].append({
-        "file_id": document.file_id,
-        "file_name": document.file_name
-    })
+    async with session_lock(chat_id):
+        session = await asyncio.to_thread(sessions.get, chat_id)
+        if session is None or session.get("state") != WAITING_FOR_PDF:
+            return
+        document = message.document
+        if document.mime_type != "application/pdf":
+            logger.info("Received non-PDF file in chat %s", chat_id)
+            await message.reply_text("This is not a PDF file. Please send a PDF.")
+            return
+        session["pdfs"].append({
+            "file_id": document.file_id,
+            "file_unique_id": document.file_unique_id,
+            "file_name": document.file_name,
+            "file_size": document.file_size
+        })
+        await asyncio.to_thread(sessions.update, chat_id, session)
     logger.info("Received PDF %s for chat %s", document.file_name, chat_id)
     await message.reply_text(f"Received {document.file_name}. You can send more PDFs or type /pdfask when done.")
 
 @app.on_message(filters.command("pdfask"))
 async def start_pdfask_handler(client: Client, message: Message):
     chat_id = message.chat.id
-    if chat_id not in user_data or not user_data[chat_id].get("pdfs"):
-        logger.warning("No PDFs found for chat %s when /pdfask was invoked", chat_id)
-        await message.reply_text("No PDFs received. Please start with /pdfwatermark and then send PDF files.")
-        return
-    user_data[chat_id]["state"] = WAITING_FOR_LOCATION
+    async with session_lock(chat_id):
+        session = await asyncio.to_thread(sessions.get, chat_id)
+        if session is None or not session.get("pdfs"):
+            logger.warning("No PDFs found for chat %s when /pdfask was invoked", chat_id)
+            await message.reply_text("No PDFs received. Please start with /pdfwatermark and then send PDF files.")
+            return
+        session["state"] = WAITING_FOR_LOCATION
+        await asyncio.to_thread(sessions.update, chat_id, session)
     logger.info("Chat %s moving to watermark location selection.", chat_id)
     await message.reply_text(
         "Choose watermark location by sending a number:\n"
@@ -351,12 +530,21 @@ async def start_pdfask_handler(client: Client, message: Message):
 @app.on_message(filters.text & ~filters.command(["pdfwatermark", "pdfask"]))
 async def handle_text_handler(client: Client, message: Message):
     chat_id = message.chat.id
-    if chat_id not in user_data:
-        logger.debug("No active session for chat %s", chat_id)
-        return
-    state = user_data[chat_id].get("state")
+    async with session_lock(chat_id):
+        session = await asyncio.to_thread(sessions.get, chat_id)
+        if session is None:
+            logger.debug("No active session for chat %s", chat_id)
+            return
+        try:
+            await handle_session_text(client, message, chat_id, session)
+        finally:
+            # A no-op if the session became a job or expired meanwhile.
+            await asyncio.to_thread(sessions.update, chat_id, session)
+
+async def handle_session_text(client: Client, message: Message, chat_id: int, session):
+    state = session.get("state")
     text = message.text.strip()
-    
+
     if state == WAITING_FOR_LOCATION:
         try:
             loc = int(text)
@@ -368,26 +556,51 @@ async def handle_text_handler(client: Client, message: Message):
             logger.warning("Non-integer location choice in chat %s: %s", chat_id, text)
             await message.reply_text("Please send a valid number for location.")
             return
-        user_data[chat_id]["location"] = loc
+        session["location"] = loc
         logger.info("Chat %s selected location %s", chat_id, loc)
         if loc == 9:
-            user_data[chat_id]["state"] = WAITING_FOR_FIND_TEXT
-            await message.reply_text("Enter the text to find (the text you want to cover up):")
+            session["state"] = WAITING_FOR_FIND_TEXT
+            await message.reply_text("Enter the text to find (the text you want to cover up).\n"
+                                     "To cover several phrases, put each one on its own line:")
         elif loc == 10:
-            await send_first_page_image(client, chat_id)
-            user_data[chat_id]["state"] = WAITING_FOR_SIDE_TOP_LEFT
+            await send_first_page_image(client, chat_id, session)
+            session["state"] = WAITING_FOR_SIDE_TOP_LEFT
             await message.reply_text("Enter the LEFT TOP normalized coordinate (format: x,y in 0-10, e.g., 2,3):")
         else:
-            user_data[chat_id]["state"] = WAITING_FOR_WATERMARK_TEXT
+            session["state"] = WAITING_FOR_WATERMARK_TEXT
             await message.reply_text("Enter watermark text:")
     elif state == WAITING_FOR_FIND_TEXT:
         if not text:
             await message.reply_text("Text to find cannot be empty. Please enter the text to cover up:")
             return
-        user_data[chat_id]["find_text"] = text
+        session["find_text"] = text
         logger.info("Chat %s provided OCR text to find: %s", chat_id, text)
-        user_data[chat_id]["state"] = WAITING_FOR_WATERMARK_TEXT
-        await message.reply_text("Enter watermark text:")
+        session["state"] = WAITING_FOR_FIND_REGION
+        await message.reply_text("Where should the text be searched? Send 'all' for whole pages, or an area as "
+                                 "LEFT TOP and RIGHT BOTTOM coordinates v,h v,h on a 0-10 grid "
+                                 "(v: 0 top to 10 bottom, h: 0 left to 10 right), e.g. 0,0 2,10 for the top fifth. "
+                                 "A smaller area is searched faster.")
+    elif state == WAITING_FOR_FIND_REGION:
+        if text.lower() == "all":
+            region = None
+        else:
+            try:
+                region = [tuple(float(value.strip()) for value in corner.split(",")) for corner in text.split()]
+            except ValueError:
+                logger.warning("Invalid search area in chat %s: %s", chat_id, text)
+                await message.reply_text("Invalid format. Send 'all' or two coordinates as v,h v,h (e.g., 0,0 2,10).")
+                return
+            try:
+                check_normalized_region(region)
+            except ValueError as e:
+                logger.warning("Invalid search area in chat %s: %s (%s)", chat_id, text, e)
+                await message.reply_text(f"Invalid area: {e}. Send 'all' or two coordinates as v,h v,h "
+                                         "between 0 and 10 (e.g., 0,0 2,10).")
+                return
+        session["find_region"] = region
+        logger.info("Chat %s search area: %s", chat_id, region or "all")
+        session["state"] = WAITING_FOR_COVER_MODE
+        await message.reply_text(COVER_MODE_PROMPT)
     elif state == WAITING_FOR_SIDE_TOP_LEFT:
         try:
             x_str, y_str = text.split(",")
@@ -396,9 +609,9 @@ async def handle_text_handler(client: Client, message: Message):
             logger.warning("Invalid LEFT TOP coordinate in chat %s: %s", chat_id, text)
             await message.reply_text("Invalid format. Please enter coordinate as x,y (e.g., 2,3).")
             return
-        user_data[chat_id]["side_coords"] = [coord]
+        session["side_coords"] = [coord]
         logger.info("Chat %s received LEFT TOP coordinate: %s", chat_id, coord)
-        user_data[chat_id]["state"] = WAITING_FOR_SIDE_BOTTOM_RIGHT
+        session["state"] = WAITING_FOR_SIDE_BOTTOM_RIGHT
         await message.reply_text("Enter the RIGHT BOTTOM normalized coordinate (format: x,y in 0-10, e.g., 8,7):")
     elif state == WAITING_FOR_SIDE_BOTTOM_RIGHT:
         try:
@@ -408,17 +621,41 @@ async def handle_text_handler(client: Client, message: Message):
             logger.warning("Invalid RIGHT BOTTOM coordinate in chat %s: %s", chat_id, text)
             await message.reply_text("Invalid format. Please enter coordinate as x,y (e.g., 8,7).")
             return
-        user_data[chat_id]["side_coords"].append(coord)
+        session["side_coords"].append(coord)
         logger.info("Chat %s received RIGHT BOTTOM coordinate: %s", chat_id, coord)
-        user_data[chat_id]["state"] = WAITING_FOR_WATERMARK_TEXT
+        session["state"] = WAITING_FOR_SIDE_CONFIRM
+        await send_cover_preview(client, chat_id, session)
+    elif state == WAITING_FOR_SIDE_CONFIRM:
+        if text.lower() in ("ok", "yes", "y"):
+            session["state"] = WAITING_FOR_COVER_MODE
+            await message.reply_text(COVER_MODE_PROMPT)
+            return
+        try:
+            x_str, y_str = text.split(",")
+            coord = (float(x_str.strip()), float(y_str.strip()))
+        except Exception:
+            await message.reply_text("Reply OK to continue, or send a new LEFT TOP coordinate as v,h (e.g., 2,3).")
+            return
+        session["side_coords"] = [coord]
+        logger.info("Chat %s redrawing cover rectangle from LEFT TOP %s", chat_id, coord)
+        session["state"] = WAITING_FOR_SIDE_BOTTOM_RIGHT
+        await message.reply_text("Enter the RIGHT BOTTOM normalized coordinate (format: x,y in 0-10, e.g., 8,7):")
+    elif state == WAITING_FOR_COVER_MODE:
+        if text not in COVER_MODE_CHOICES:
+            logger.warning("Invalid cover mode choice in chat %s: %s", chat_id, text)
+            await message.reply_text("Invalid choice. Please choose 1, 2, 3 or 4.")
+            return
+        session["cover_mode"], session["redact_images"] = COVER_MODE_CHOICES[text]
+        logger.info("Chat %s chose cover mode %s (images: %s)", chat_id, *COVER_MODE_CHOICES[text])
+        session["state"] = WAITING_FOR_WATERMARK_TEXT
         await message.reply_text("Enter watermark text:")
     elif state == WAITING_FOR_WATERMARK_TEXT:
         if not text:
             await message.reply_text("Watermark text cannot be empty. Please enter the watermark text.")
             return
-        user_data[chat_id]["watermark_text"] = text
+        session["watermark_text"] = text
         logger.info("Chat %s provided watermark text: %s", chat_id, text)
-        user_data[chat_id]["state"] = WAITING_FOR_TEXT_SIZE
+        session["state"] = WAITING_FOR_TEXT_SIZE
         await message.reply_text("Enter watermark text size (e.g., 24):")
     elif state == WAITING_FOR_TEXT_SIZE:
         try:
@@ -427,9 +664,9 @@ async def handle_text_handler(client: Client, message: Message):
             logger.warning("Invalid text size provided in chat %s: %s", chat_id, text)
             await message.reply_text("Please send a valid number for text size.")
             return
-        user_data[chat_id]["text_size"] = size
+        session["text_size"] = size
         logger.info("Chat %s set text size to: %s", chat_id, size)
-        user_data[chat_id]["state"] = WAITING_FOR_COLOR
+        session["state"] = WAITING_FOR_COLOR
         await message.reply_text("Choose watermark text colour by sending a number:\n1. Red\n2. Black\n3. White")
     elif state == WAITING_FOR_COLOR:
         mapping = {"1": "red", "2": "black", "3": "white"}
@@ -437,16 +674,55 @@ async def handle_text_handler(client: Client, message: Message):
             logger.warning("Invalid colour choice in chat %s: %s", chat_id, text)
             await message.reply_text("Invalid choice. Please choose 1, 2, or 3 for colour.")
             return
-        user_data[chat_id]["color"] = mapping[text]
+        session["color"] = mapping[text]
         logger.info("Chat %s set colour to: %s", chat_id, mapping[text])
-        await message.reply_text("PDF watermarking started.")
-        await process_pdfs_handler(client, chat_id)
-        logger.info("PDF processing completed for chat %s", chat_id)
-        user_data.pop(chat_id, None)
+        # The conversation is complete: it becomes a job and its session ends.
+        job_id = await asyncio.to_thread(job_queue.enqueue, chat_id, session)
+        await asyncio.to_thread(sessions.delete, chat_id, session["id"])
+        ahead = await asyncio.to_thread(job_queue.position, job_id)
+        if ahead:
+            await message.reply_text(f"PDF watermarking queued: {ahead} job(s) ahead of yours.")
+        else:
+            await message.reply_text("PDF watermarking started.")
 
 @app.on_message(filters.text & ~filters.command(["pdfwatermark", "pdfask"]))
 async def extra_text_handler(client: Client, message: Message):
     # This handler is here if any extra text comes in while no state is active.
     logger.debug("Extra text received in chat %s: %s", message.chat.id, message.text)
 
-app.run()
+register_gauge("queue_depth", lambda: worker_pool.queue_depth)
+register_gauge("job_queue_depth", job_queue.depth)
+register_gauge("active_sessions", sessions.count)
+register_gauge("active_uploads", lambda: upload_scheduler.active)
+
+async def run(client: Client, consumers, handle_updates):
+    """
+    Starts the client with `consumers` job consumers and, for the bot itself, session
+    expiry; runs until the process is stopped.
+    """
+    await client.start()
+    worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+    tasks = [asyncio.create_task(consume_jobs(client, f"{worker_prefix}-{i}")) for i in range(consumers)]
+    if handle_updates:
+        tasks.append(asyncio.create_task(expire_sessions()))
+    try:
+        await idle()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.stop()
+
+if __name__ == "__main__":
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.warning("Metrics endpoint not started on port %d: %s", METRICS_PORT, e)
+    if "--worker" in sys.argv[1:]:
+        # Extra consumer process: takes jobs from the queue but does not handle chat updates.
+        worker_client = Client("pdf_watermark_worker", bot_token=BOT_TOKEN, api_id=API_ID, api_hash=API_HASH,
+                               in_memory=True, no_updates=True)
+        worker_client.run(run(worker_client, JOB_CONSUMERS, handle_updates=False))
+    else:
+        app.run(run(app, JOB_CONSUMERS, handle_updates=True))
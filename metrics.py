@@ -0,0 +1,210 @@
+import os
+import time
+import logging
+import cProfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Phase names used by the watermarking code.
+PHASE_RENDER = "render"
+PHASE_OCR = "ocr"
+PHASE_SEARCH = "search"
+PHASE_DRAW = "draw"
+PHASE_SAVE = "save"
+# Phases of the bot's batch pipeline, measured in the bot process.
+PHASE_DOWNLOAD = "download"
+PHASE_UPLOAD = "upload"
+
+# Counter names.
+COUNTER_PAGES = "pages_processed"
+COUNTER_OCR_WORDS = "ocr_words"
+COUNTER_TEXT_WORDS = "text_layer_words"
+COUNTER_OCR_PAGES = "ocr_pages"
+COUNTER_OCR_RERUNS = "ocr_reruns"
+COUNTER_OCR_PIXELS = "ocr_pixels"
+COUNTER_OCR_DPI_SUM = "ocr_dpi_sum"
+COUNTER_OCR_CONFIDENCE_SUM = "ocr_confidence_sum"
+COUNTER_OCR_CONFIDENT_WORDS = "ocr_confident_words"
+COUNTER_REDACTIONS = "redactions"
+COUNTER_BYTES_IN = "bytes_in"
+COUNTER_BYTES_OUT = "bytes_out"
+COUNTER_JOBS_COMPLETED = "jobs_completed"
+COUNTER_JOBS_FAILED = "jobs_failed"
+
+# Accumulated wall time and call count per phase, and counters, for this process.
+# The lock makes them safe to read from the metrics HTTP thread.
+_lock = threading.Lock()
+_phase_seconds = defaultdict(float)
+_phase_calls = defaultdict(int)
+_counters = defaultdict(int)
+# Gauges are read when the metrics are scraped: name -> callable returning a number.
+_gauges = {}
+
+@contextmanager
+def timed(phase):
+    """
+    Adds the wall time of the enclosed block to the given phase.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _lock:
+            _phase_seconds[phase] += elapsed
+            _phase_calls[phase] += 1
+
+def count(name, amount=1):
+    """
+    Adds amount to a counter.
+    """
+    with _lock:
+        _counters[name] += amount
+
+def register_gauge(name, read):
+    """
+    Registers a gauge whose value is read() at scrape time.
+    """
+    _gauges[name] = read
+
+def phase_snapshot():
+    """
+    Returns {phase: (seconds, calls)} accumulated in this process so far.
+    """
+    with _lock:
+        return {phase: (_phase_seconds[phase], _phase_calls[phase]) for phase in _phase_seconds}
+
+def phase_delta(before, after):
+    """
+    Returns the phases accumulated between two phase_snapshot() results.
+    """
+    delta = {}
+    for phase, (seconds, calls) in after.items():
+        old_seconds, old_calls = before.get(phase, (0.0, 0))
+        if calls != old_calls:
+            delta[phase] = (seconds - old_seconds, calls - old_calls)
+    return delta
+
+def merge_phases(phases):
+    """
+    Adds phases measured in another process (e.g. an OCR worker) to this process's totals.
+    """
+    with _lock:
+        for phase, (seconds, calls) in phases.items():
+            _phase_seconds[phase] += seconds
+            _phase_calls[phase] += calls
+
+def reset_phases():
+    with _lock:
+        _phase_seconds.clear()
+        _phase_calls.clear()
+
+def snapshot():
+    """
+    Returns the phases and counters accumulated in this process so far.
+    """
+    with _lock:
+        counters = dict(_counters)
+    return {"phases": phase_snapshot(), "counters": counters}
+
+def delta(before, after):
+    """
+    Returns the phases and counters accumulated between two snapshot() results.
+    """
+    counters = {}
+    for name, value in after["counters"].items():
+        if value != before["counters"].get(name, 0):
+            counters[name] = value - before["counters"].get(name, 0)
+    return {"phases": phase_delta(before["phases"], after["phases"]), "counters": counters}
+
+def merge(metrics):
+    """
+    Adds a delta() measured in another process to this process's totals.
+    """
+    merge_phases(metrics["phases"])
+    with _lock:
+        for name, value in metrics["counters"].items():
+            _counters[name] += value
+
+def format_phases(phases):
+    """
+    Formats {phase: (seconds, calls)} for a log line, e.g. "render 0.42s, ocr 3.10s".
+    """
+    return ", ".join(f"{phase} {seconds:.2f}s" for phase, (seconds, _) in sorted(phases.items())) or "-"
+
+def run_instrumented(fn, args, kwargs, profile_dir=None, profile_name=None):
+    """
+    Calls fn(*args, **kwargs), typically in a worker process, and returns
+    (result, delta) with the phases and counters the call accumulated, for the
+    parent process to merge. When profile_dir is set, the call runs under cProfile
+    and the stats are written to profile_dir as "<profile_name>-<time>-<pid>.prof"
+    (readable with pstats or snakeviz).
+    """
+    before = snapshot()
+    if not profile_dir:
+        result = fn(*args, **kwargs)
+        return result, delta(before, snapshot())
+    profiler = cProfile.Profile()
+    logger.info("Profiling %s in pid %d", profile_name or fn.__name__, os.getpid())
+    try:
+        result = profiler.runcall(fn, *args, **kwargs)
+    finally:
+        os.makedirs(profile_dir, exist_ok=True)
+        profile_path = os.path.join(
+            profile_dir, f"{profile_name or fn.__name__}-{int(time.time() * 1000)}-{os.getpid()}.prof")
+        profiler.dump_stats(profile_path)
+        logger.info("Profile written: %s", profile_path)
+    return result, delta(before, snapshot())
+
+def render_metrics(prefix="pdfwm"):
+    """
+    Returns this process's phases, counters and gauges in the Prometheus text format.
+    """
+    current = snapshot()
+    lines = [f"# TYPE {prefix}_phase_seconds_total counter"]
+    for phase, (seconds, _) in sorted(current["phases"].items()):
+        lines.append(f'{prefix}_phase_seconds_total{{phase="{phase}"}} {seconds:.6f}')
+    lines.append(f"# TYPE {prefix}_phase_calls_total counter")
+    for phase, (_, calls) in sorted(current["phases"].items()):
+        lines.append(f'{prefix}_phase_calls_total{{phase="{phase}"}} {calls}')
+    for name, value in sorted(current["counters"].items()):
+        lines.append(f"# TYPE {prefix}_{name}_total counter")
+        lines.append(f"{prefix}_{name}_total {value}")
+    for name, read in sorted(_gauges.items()):
+        try:
+            value = read()
+        except Exception as e:
+            logger.debug("Gauge %s could not be read: %s", name, e)
+            continue
+        lines.append(f"# TYPE {prefix}_{name} gauge")
+        lines.append(f"{prefix}_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format, *args)
+
+def start_metrics_server(host, port):
+    """
+    Serves render_metrics() at http://host:port/metrics from a daemon thread.
+    Returns the server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Metrics endpoint listening on http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,449 @@
+import os
+import logging
+import tempfile
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytesseract
+from PIL import Image
+import fitz  # PyMuPDF
+
+from config import (
+    TESSERACT_CMD, OCR_WORKERS, OCR_PAGES_PER_SHARD, OCR_DPI, TEXT_LAYER_MIN_WORDS,
+    SCANNED_PAGE_IMAGE_COVERAGE, TEXT_LAYER_MIN_COVERAGE,
+    OCR_INDEX_PATH, OCR_INDEX_MAX_AGE_DAYS, OCR_GRAYSCALE, OCR_ADAPTIVE_DPI, OCR_MIN_DPI, OCR_MAX_DPI,
+    OCR_TARGET_TEXT_PX, OCR_RERUN_FACTOR, OCR_PSM, OCR_LANG, OCR_WHITELIST
+)
+from geometry import normalized_rect, normalized_visible_rect
+from ocr_index import PageWords, OCRIndex, file_sha256
+from workspace import open_pdf
+from worker_pool import in_worker
+from metrics import (
+    PHASE_RENDER, PHASE_OCR, PHASE_SEARCH, COUNTER_OCR_WORDS, COUNTER_TEXT_WORDS, COUNTER_OCR_PAGES,
+    COUNTER_OCR_RERUNS, COUNTER_OCR_PIXELS, COUNTER_OCR_DPI_SUM, COUNTER_OCR_CONFIDENCE_SUM,
+    COUNTER_OCR_CONFIDENT_WORDS, timed, count, snapshot, delta, merge
+)
+pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+
+logger = logging.getLogger(__name__)
+
+# How the words of a page were obtained.
+METHOD_TEXT = "text"
+METHOD_OCR = "ocr"
+METHOD_OCR_INDEX = "ocr-index"
+
+_shard_pool = None  # (workers, ProcessPoolExecutor) reused by every OCR run of this process
+_ocr_tokens = None  # semaphore of OCR processes shared by a WorkerPool's processes
+
+def page_shards(page_numbers, pages_per_shard):
+    """
+    Splits a list of page numbers into consecutive chunks of at most pages_per_shard pages.
+    """
+    pages_per_shard = max(1, pages_per_shard)
+    return [page_numbers[i:i + pages_per_shard] for i in range(0, len(page_numbers), pages_per_shard)]
+
+def parse_phrases(find_text):
+    """
+    Splits the user's find text into phrases: one phrase per non-empty line.
+    A list or tuple of phrases is returned as a list unchanged.
+    """
+    if isinstance(find_text, (list, tuple)):
+        return list(find_text)
+    return [line.strip() for line in find_text.splitlines() if line.strip()]
+
+def match_phrase(words, phrase):
+    """
+    Finds every occurrence of phrase in a page's PageWords and returns the matched areas.
+    Words are compared case-insensitively as whole words, so multi-word phrases match
+    consecutive words. A match spanning several lines yields one rect tuple per line.
+    """
+    tokens = phrase.lower().split()
+    if not tokens:
+        return []
+    texts = [text.strip().lower() for text in words.texts]
+    boxes = []
+    for i in range(len(texts) - len(tokens) + 1):
+        if texts[i:i + len(tokens)] != tokens:
+            continue
+        line_rects = {}
+        for j in range(i, i + len(tokens)):
+            line = words.lines[j]
+            if line in line_rects:
+                line_rects[line] |= words.rect(j)
+            else:
+                line_rects[line] = words.rect(j)
+        boxes.extend(tuple(rect) for rect in line_rects.values())
+    return boxes
+
+def match_phrases(words, phrases):
+    """
+    Returns the matched areas of all phrases on one page, phrase by phrase.
+    """
+    boxes = []
+    for phrase in phrases:
+        boxes.extend(match_phrase(words, phrase))
+    return boxes
+
+def text_layer_words(page):
+    """
+    Returns the words of a page's native text layer as PageWords.
+    """
+    words = PageWords()
+    line_numbers = {}
+    for w in page.get_text("words"):
+        line = line_numbers.setdefault((w[5], w[6]), len(line_numbers))
+        words.append(w[4], w[:4], line)
+    return words
+
+def image_coverage(page):
+    """
+    Returns the share of the page covered by images, from 0 to 1. Overlapping images
+    are counted once each, so the share is an upper bound.
+    """
+    area = page.rect * page.derotation_matrix
+    covered = sum(abs(fitz.Rect(info["bbox"]) & area) for info in page.get_image_info())
+    return min(1.0, covered / abs(area)) if abs(area) else 0.0
+
+def has_usable_text(page, words):
+    """
+    A text layer is usable when it has enough words that contain real characters;
+    broken font encodings extract as U+FFFD replacement characters only. On a scanned
+    page the words must also cover a fair part of the page, or they are only what was
+    added after scanning (a page number, a stamp) and the scan itself needs OCR.
+    """
+    usable = [i for i, text in enumerate(words.texts) if any(ch.isalnum() and ch != "�" for ch in text)]
+    if len(usable) < TEXT_LAYER_MIN_WORDS:
+        return False
+    if image_coverage(page) < SCANNED_PAGE_IMAGE_COVERAGE:
+        return True
+    area = page.rect * page.derotation_matrix
+    covered = sum(abs(words.rect(i) & area) for i in usable)
+    return bool(abs(area)) and covered / abs(area) >= TEXT_LAYER_MIN_COVERAGE
+
+def ocr_settings(**overrides):
+    """
+    Returns the OCR settings from the configuration, with the given overrides:
+    dpi, adaptive_dpi, grayscale, psm, lang and whitelist.
+    """
+    settings = {
+        "dpi": OCR_DPI, "adaptive_dpi": OCR_ADAPTIVE_DPI, "grayscale": OCR_GRAYSCALE,
+        "psm": OCR_PSM, "lang": OCR_LANG, "whitelist": OCR_WHITELIST,
+    }
+    unknown = set(overrides) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown OCR setting(s): {', '.join(sorted(unknown))}")
+    settings.update(overrides)
+    return settings
+
+def describe_settings(settings, region=None):
+    """
+    Returns a short description of OCR settings, also used to key the OCR index:
+    results obtained with different settings are stored separately.
+    """
+    parts = [f"dpi=auto({settings['dpi']})" if settings["adaptive_dpi"] else f"dpi={settings['dpi']}",
+             "gray" if settings["grayscale"] else "rgb", f"lang={settings['lang']}"]
+    if settings["psm"]:
+        parts.append(f"psm={settings['psm']}")
+    if settings["whitelist"]:
+        parts.append(f"whitelist={settings['whitelist']}")
+    if region:
+        parts.append("region=" + "-".join(f"{v:g},{h:g}" for v, h in region))
+    return ";".join(parts)
+
+def tesseract_config(settings):
+    parts = []
+    if settings["psm"]:
+        parts.append(f"--psm {settings['psm']}")
+    if settings["whitelist"]:
+        parts.append(f"-c tessedit_char_whitelist={settings['whitelist']}")
+    return " ".join(parts)
+
+def choose_dpi(text_height):
+    """
+    Returns the DPI at which words text_height points tall come out about
+    OCR_TARGET_TEXT_PX pixels tall, within OCR_MIN_DPI..OCR_MAX_DPI.
+    """
+    dpi = int(OCR_TARGET_TEXT_PX * 72 / text_height)
+    return max(OCR_MIN_DPI, min(OCR_MAX_DPI, dpi))
+
+def ocr_page_words(page, dpi=OCR_DPI, settings=None, clip=None):
+    """
+    Renders a page (or only the clip rectangle, in page.rect coordinates) and OCRs it
+    with tesseract. Returns (words, stats): the recognised words as PageWords, with boxes
+    in (unrotated) page coordinates, and a dict with the dpi, pixel count, tesseract
+    confidences and the median word height in points (None without words).
+    """
+    settings = settings or ocr_settings()
+    scale = dpi / 72
+    with timed(PHASE_RENDER):
+        if settings["grayscale"]:
+            pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), colorspace=fitz.csGRAY, clip=clip)
+            img = Image.frombytes("L", [pix.width, pix.height], pix.samples)
+        else:
+            pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), clip=clip)
+            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    with timed(PHASE_OCR):
+        ocr_data = pytesseract.image_to_data(img, lang=settings["lang"], config=tesseract_config(settings),
+                                             output_type=pytesseract.Output.DICT)
+    offset_x, offset_y = (clip.x0, clip.y0) if clip is not None else (0, 0)
+    derotate = page.derotation_matrix
+    words = PageWords()
+    line_numbers = {}
+    heights = []
+    confidences = []
+    for i in range(len(ocr_data["text"])):
+        text = ocr_data["text"][i]
+        if not text.strip():
+            continue
+        left = offset_x + ocr_data["left"][i] / scale
+        top = offset_y + ocr_data["top"][i] / scale
+        right = left + ocr_data["width"][i] / scale
+        bottom = top + ocr_data["height"][i] / scale
+        rect = fitz.Rect(left, top, right, bottom) * derotate
+        line_key = (ocr_data["block_num"][i], ocr_data["par_num"][i], ocr_data["line_num"][i])
+        words.append(text, tuple(rect), line_numbers.setdefault(line_key, len(line_numbers)))
+        confidence = float(ocr_data["conf"][i])
+        if confidence >= 0:
+            confidences.append(confidence)
+            heights.append(ocr_data["height"][i] / scale)
+    count(COUNTER_OCR_WORDS, len(words.texts))
+    stats = {
+        "dpi": dpi, "pixels": pix.width * pix.height,
+        "confidence_sum": sum(confidences), "confident_words": len(confidences),
+        "text_height": statistics.median(heights) if heights else None,
+    }
+    return words, stats
+
+def ocr_pages(input_pdf_path, page_numbers, settings=None, region=None):
+    """
+    OCRs the given pages of a PDF. Runs in a worker process: it opens its own PyMuPDF
+    document and returns ([(page_number, PageWords)], metrics). PageWords pickle as a few
+    compact arrays; metrics are the worker's timings and counters for the parent to merge.
+
+    region limits OCR to two normalized (v,h) corners. With adaptive DPI each page starts
+    at the DPI suited to the text of the previous page, so results depend on the shard
+    layout but not on the number of workers.
+    """
+    settings = settings or ocr_settings()
+    before = snapshot()
+    results = []
+    dpi = settings["dpi"]
+    with open_pdf(input_pdf_path) as doc:
+        for page_number in page_numbers:
+            page = doc[page_number]
+            clip = normalized_visible_rect(page, region) if region else None
+            words, stats = ocr_page_words(page, dpi, settings, clip)
+            if settings["adaptive_dpi"] and stats["text_height"]:
+                wanted = choose_dpi(stats["text_height"])
+                if wanted > dpi * OCR_RERUN_FACTOR:
+                    # Text too small to read reliably at this DPI: OCR the page again.
+                    logger.debug("Page %d: text %.1fpt tall, OCR again at %d dpi",
+                                 page_number, stats["text_height"], wanted)
+                    count(COUNTER_OCR_RERUNS)
+                    words, stats = ocr_page_words(page, wanted, settings, clip)
+                if stats["text_height"]:
+                    dpi = choose_dpi(stats["text_height"])
+            count(COUNTER_OCR_PAGES)
+            count(COUNTER_OCR_PIXELS, stats["pixels"])
+            count(COUNTER_OCR_DPI_SUM, stats["dpi"])
+            count(COUNTER_OCR_CONFIDENCE_SUM, stats["confidence_sum"])
+            count(COUNTER_OCR_CONFIDENT_WORDS, stats["confident_words"])
+            results.append((page_number, words))
+    return results, delta(before, snapshot())
+
+def format_ocr_report(metrics):
+    """
+    Summarises the OCR counters and timings of a metrics delta: pages, average DPI,
+    time and megapixels per page, mean tesseract confidence and reruns. Returns an
+    empty string when no page was OCRed.
+    """
+    counters = metrics["counters"]
+    pages = counters.get(COUNTER_OCR_PAGES, 0)
+    if not pages:
+        return ""
+    seconds = sum(metrics["phases"].get(phase, (0.0, 0))[0] for phase in (PHASE_RENDER, PHASE_OCR))
+    confident = counters.get(COUNTER_OCR_CONFIDENT_WORDS, 0)
+    confidence = counters.get(COUNTER_OCR_CONFIDENCE_SUM, 0) / confident if confident else 0.0
+    return (f"OCR {pages} page(s) at avg {counters.get(COUNTER_OCR_DPI_SUM, 0) / pages:.0f} dpi, "
+            f"{seconds / pages:.2f}s/page, {counters.get(COUNTER_OCR_PIXELS, 0) / pages / 1e6:.1f} Mpx/page, "
+            f"confidence {confidence:.1f}%, {counters.get(COUNTER_OCR_RERUNS, 0)} rerun(s)")
+
+def ocr_process_setup():
+    """
+    WorkerPool process_setup: gives the pool's processes a new budget of OCR_WORKERS
+    OCR processes to share, so the jobs running at once together use at most that many.
+    A new budget per pool start means tokens held by a process that died are not lost.
+    """
+    return _use_ocr_tokens, (multiprocessing.BoundedSemaphore(OCR_WORKERS),)
+
+def _use_ocr_tokens(tokens):
+    global _ocr_tokens
+    _ocr_tokens = tokens
+
+def _acquire_ocr_tokens(wanted):
+    """
+    Takes up to `wanted` tokens from the shared OCR budget, waiting only for the first,
+    and returns how many were taken. Without a budget all `wanted` are granted.
+    """
+    if _ocr_tokens is None:
+        return wanted
+    _ocr_tokens.acquire()
+    taken = 1
+    while taken < wanted and _ocr_tokens.acquire(block=False):
+        taken += 1
+    return taken
+
+def _release_ocr_tokens(taken):
+    if _ocr_tokens is not None:
+        for _ in range(taken):
+            _ocr_tokens.release()
+
+def _shard_executor(workers):
+    """
+    Returns the process pool for OCR shards, started on first use and kept for later
+    calls with the same number of workers, so runs do not each pay for a pool start.
+    """
+    global _shard_pool
+    if _shard_pool is None or _shard_pool[0] != workers:
+        if _shard_pool is not None:
+            _shard_pool[1].shutdown(wait=False)
+        _shard_pool = (workers, ProcessPoolExecutor(max_workers=workers))
+    return _shard_pool[1]
+
+def _run_shards(input_pdf_path, shards, workers, settings, region):
+    global _shard_pool
+    if in_worker():
+        # A pool kept alive in a WorkerPool process would stop it from exiting.
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(ocr_pages, input_pdf_path, shard, settings, region) for shard in shards]
+            return [future.result() for future in futures]
+    try:
+        executor = _shard_executor(workers)
+        futures = [executor.submit(ocr_pages, input_pdf_path, shard, settings, region) for shard in shards]
+        return [future.result() for future in futures]
+    except BrokenProcessPool:
+        _shard_pool = None
+        raise
+
+def shutdown_shard_pool():
+    """
+    Stops the process pool kept for OCR shards, waiting for its processes to exit.
+    """
+    global _shard_pool
+    if _shard_pool is not None:
+        _shard_pool[1].shutdown()
+        _shard_pool = None
+
+def _ocr_shards(input_pdf_path, shards, workers, settings, region, work_dir):
+    """
+    OCRs the shards with ocr_pages, in this process when workers is 1 and otherwise in
+    a process pool: the one kept for this process, or a pool of its own per call inside
+    a WorkerPool process.
+    A PDF given as bytes is first written to a temporary file in work_dir, so the
+    shards open that file instead of each receiving a copy.
+    """
+    if workers == 1:
+        return [ocr_pages(input_pdf_path, shard, settings, region) for shard in shards]
+    spill_path = None
+    if isinstance(input_pdf_path, (bytes, bytearray)):
+        fd, spill_path = tempfile.mkstemp(suffix=".pdf", dir=work_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(input_pdf_path)
+        input_pdf_path = spill_path
+    try:
+        return _run_shards(input_pdf_path, shards, workers, settings, region)
+    finally:
+        if spill_path:
+            os.remove(spill_path)
+
+def get_ocr_index():
+    """
+    Returns the OCRIndex configured by OCR_INDEX_PATH, or None when it is disabled.
+    """
+    if not OCR_INDEX_PATH:
+        return None
+    return OCRIndex(OCR_INDEX_PATH, OCR_INDEX_MAX_AGE_DAYS * 86400)
+
+def find_text_boxes(input_pdf_path, find_text, workers=None, pages_per_shard=OCR_PAGES_PER_SHARD,
+                    settings=None, region=None, work_dir=None):
+    """
+    Finds find_text on every page of a PDF. find_text may hold several phrases, one per
+    line (or be a list of phrases); all of them are searched in the same pass.
+
+    Pages with a usable text layer are searched directly. The rest are looked up in the
+    OCR index and, if missing, OCRed with page shards spread across `workers` processes;
+    fresh OCR results are added to the index. Results are assembled in page order, so
+    they are identical to a serial run (workers=1). workers defaults to OCR_WORKERS;
+    inside a WorkerPool process it is further limited to what is left of the OCR budget
+    the pool's jobs share (see ocr_process_setup). input_pdf_path may also be the PDF's bytes; for OCR in
+    several processes they are written to a temporary file in work_dir (the system
+    temporary directory by default). settings come from ocr_settings(). region, two
+    normalized (v,h) corners on the 0-10 grid, limits both OCR and matches to that part
+    of each page.
+
+    Returns (boxes_by_page, methods_by_page): {page_number: [rect tuples]} and
+    {page_number: METHOD_TEXT, METHOD_OCR or METHOD_OCR_INDEX}.
+    """
+    phrases = parse_phrases(find_text)
+    settings = settings or ocr_settings()
+    boxes_by_page = {}
+    methods_by_page = {}
+    ocr_needed = []
+    with open_pdf(input_pdf_path) as doc, timed(PHASE_SEARCH):
+        for page in doc:
+            words = text_layer_words(page)
+            count(COUNTER_TEXT_WORDS, len(words.texts))
+            if has_usable_text(page, words):
+                boxes_by_page[page.number] = match_phrases(words, phrases)
+                methods_by_page[page.number] = METHOD_TEXT
+            else:
+                ocr_needed.append(page.number)
+                methods_by_page[page.number] = METHOD_OCR
+
+    if ocr_needed:
+        index = get_ocr_index()
+        variant = describe_settings(settings, region)
+        words_by_page = {}
+        if index is not None:
+            doc_hash = file_sha256(input_pdf_path)
+            words_by_page = index.get_many(doc_hash, ocr_needed, variant)
+            for page_number in words_by_page:
+                methods_by_page[page_number] = METHOD_OCR_INDEX
+            logger.info("OCR index answered %d of %d page(s)", len(words_by_page), len(ocr_needed))
+        to_ocr = [page_number for page_number in ocr_needed if page_number not in words_by_page]
+
+        if to_ocr:
+            before = snapshot()
+            shards = page_shards(to_ocr, pages_per_shard)
+            workers = _acquire_ocr_tokens(min(max(1, OCR_WORKERS if workers is None else workers), len(shards)))
+            try:
+                logger.info("OCR of %d page(s) in %d shard(s) using %d worker(s)", len(to_ocr), len(shards), workers)
+                shard_results = _ocr_shards(input_pdf_path, shards, workers, settings, region, work_dir)
+            finally:
+                _release_ocr_tokens(workers)
+            fresh = {}
+            for shard, metrics in shard_results:
+                if workers > 1:
+                    merge(metrics)
+                fresh.update(shard)
+            logger.info("%s with %s", format_ocr_report(delta(before, snapshot())), variant)
+            if index is not None:
+                index.put_many(doc_hash, fresh, variant)
+            words_by_page.update(fresh)
+
+        with timed(PHASE_SEARCH):
+            for page_number in ocr_needed:
+                boxes_by_page[page_number] = match_phrases(words_by_page[page_number], phrases)
+
+    if region:
+        with open_pdf(input_pdf_path) as doc:
+            for page_number, boxes in boxes_by_page.items():
+                area = normalized_rect(doc[page_number], region)
+                boxes_by_page[page_number] = [box for box in boxes if fitz.Rect(box).intersects(area)]
+
+    for page_number in sorted(methods_by_page):
+        logger.info("Page %d searched via %s: %d match(es)",
+                    page_number, methods_by_page[page_number], len(boxes_by_page[page_number]))
+    return boxes_by_page, methods_by_page
@@ -0,0 +1,114 @@
+import os
+import time
+import hashlib
+import logging
+from array import array
+
+import fitz  # PyMuPDF
+
+from sqlite_db import connect
+
+logger = logging.getLogger(__name__)
+
+# Separates word texts in the serialized form; never produced by tesseract or PyMuPDF.
+_TEXT_SEPARATOR = "\x1f"
+
+
+class PageWords:
+    """
+    The words of one page in compact, array-backed form.
+    texts[i] is the i-th word in reading order, boxes[4*i:4*i+4] its (x0, y0, x1, y1)
+    in page coordinates and lines[i] the index of the text line it belongs to.
+    """
+
+    def __init__(self, texts=None, boxes=None, lines=None):
+        self.texts = texts if texts is not None else []
+        self.boxes = boxes if boxes is not None else array("f")
+        self.lines = lines if lines is not None else array("I")
+
+    def __len__(self):
+        return len(self.texts)
+
+    def append(self, text, box, line):
+        self.texts.append(text)
+        self.boxes.extend(box)
+        self.lines.append(line)
+
+    def rect(self, i):
+        return fitz.Rect(*self.boxes[4 * i:4 * i + 4])
+
+    def to_bytes(self):
+        """
+        Returns (texts, boxes, lines) blobs for storage.
+        """
+        return (_TEXT_SEPARATOR.join(self.texts).encode("utf-8"),
+                self.boxes.tobytes(), self.lines.tobytes())
+
+    @classmethod
+    def from_bytes(cls, texts_blob, boxes_blob, lines_blob):
+        texts = texts_blob.decode("utf-8").split(_TEXT_SEPARATOR) if texts_blob else []
+        boxes = array("f")
+        boxes.frombytes(boxes_blob)
+        lines = array("I")
+        lines.frombytes(lines_blob)
+        return cls(texts, boxes, lines)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    Hashes a file in chunks, so large PDFs are never read into memory at once.
+    A PDF already held in memory may be passed as bytes instead of a path.
+    """
+    if isinstance(path, (bytes, bytearray)):
+        return hashlib.sha256(path).hexdigest()
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OCRIndex:
+    """
+    Persistent store of OCR results per page, keyed on (document hash, page number, variant).
+    The variant string describes the OCR settings (DPI and so on) that produced the words.
+    Tesseract output only depends on the page pixels and these settings, so any later
+    Cover-Up search of the same document can be answered from the index without re-OCRing.
+    Entries older than max_age_seconds are pruned when the index is opened.
+    """
+
+    def __init__(self, db_path, max_age_seconds):
+        self.db_path = db_path
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with connect(self.db_path) as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS pages (
+                doc_hash TEXT NOT NULL, page INTEGER NOT NULL, variant TEXT NOT NULL,
+                texts BLOB NOT NULL, boxes BLOB NOT NULL, lines BLOB NOT NULL, created REAL NOT NULL,
+                PRIMARY KEY (doc_hash, page, variant))""")
+            db.execute("DELETE FROM pages WHERE created < ?", (time.time() - max_age_seconds,))
+
+    def get_many(self, doc_hash, page_numbers, variant):
+        """
+        Returns {page_number: PageWords} for the requested pages that are in the index.
+        """
+        wanted = set(page_numbers)
+        found = {}
+        with connect(self.db_path) as db:
+            rows = db.execute("SELECT page, texts, boxes, lines FROM pages WHERE doc_hash = ? AND variant = ?",
+                              (doc_hash, variant))
+            for page_number, texts, boxes, lines in rows:
+                if page_number in wanted:
+                    found[page_number] = PageWords.from_bytes(texts, boxes, lines)
+        return found
+
+    def put_many(self, doc_hash, words_by_page, variant):
+        """
+        Stores {page_number: PageWords} OCR results.
+        """
+        now = time.time()
+        with connect(self.db_path) as db:
+            db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [(doc_hash, page_number, variant, *words.to_bytes(), now)
+                            for page_number, words in words_by_page.items()])
@@ -0,0 +1,49 @@
+import logging
+
+from config import (OUTPUT_GARBAGE, OUTPUT_DEFLATE, OUTPUT_OBJECT_STREAMS, OUTPUT_IMAGE_QUALITY,
+                    OUTPUT_IMAGE_DPI)
+
+logger = logging.getLogger(__name__)
+
+
+def save_options():
+    """
+    Returns the Document.save/tobytes keyword arguments outputs are written with:
+    garbage collection and deduplication (OUTPUT_GARBAGE), compression of every
+    uncompressed stream including images and fonts (OUTPUT_DEFLATE), and packing of
+    objects into compressed object streams (OUTPUT_OBJECT_STREAMS).
+    """
+    return {"garbage": OUTPUT_GARBAGE, "deflate": OUTPUT_DEFLATE, "deflate_images": OUTPUT_DEFLATE,
+            "deflate_fonts": OUTPUT_DEFLATE, "use_objstms": int(OUTPUT_OBJECT_STREAMS)}
+
+
+def recompress_images(doc, quality=OUTPUT_IMAGE_QUALITY, max_dpi=OUTPUT_IMAGE_DPI):
+    """
+    Re-encodes the document's colour and grey images as JPEG with the given quality
+    (1-100); images above max_dpi are also downsampled towards it (MuPDF subsamples by
+    whole factors). Black-and-white images are left alone, as JPEG suits them badly.
+    Does nothing when quality is 0 or PyMuPDF is too old to rewrite images.
+    Returns True if the images were rewritten.
+    """
+    if not quality:
+        return False
+    if not hasattr(doc, "rewrite_images"):
+        logger.warning("Image recompression needs a newer PyMuPDF; writing images unchanged")
+        return False
+    if max_dpi:
+        doc.rewrite_images(dpi_threshold=max_dpi + 1, dpi_target=max_dpi, quality=quality, bitonal=False)
+    else:
+        doc.rewrite_images(quality=quality, bitonal=False)
+    return True
+
+
+def write_output(doc, output_path=None):
+    """
+    The output stage: recompresses images if OUTPUT_IMAGE_QUALITY is set and writes doc
+    with save_options(), to output_path or, without one, as bytes that are returned.
+    """
+    recompress_images(doc)
+    if output_path is None:
+        return doc.tobytes(**save_options())
+    doc.save(output_path, **save_options())
+    return output_path
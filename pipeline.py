@@ -0,0 +1,142 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Stage names, recorded on items that fail.
+STAGE_DOWNLOAD = "download"
+STAGE_PROCESS = "process"
+STAGE_UPLOAD = "upload"
+
+
+class PipelineItem:
+    """
+    One file travelling through the pipeline. Stage callbacks store their results
+    on it (input_path, output_path, ...); a stage that raises sets `error` and
+    `failed_stage`, and later stages skip the item.
+    """
+
+    def __init__(self, index, payload):
+        self.index = index
+        self.payload = payload
+        self.input_path = None
+        self.output_path = None
+        self.error = None
+        self.failed_stage = None
+        self.processed = asyncio.Event()
+        self.cleaned_up = False
+
+
+async def _run_stage(item, stage, fn):
+    if item.error is not None:
+        return
+    try:
+        await fn(item)
+    except Exception as e:
+        logger.warning("Pipeline %s failed for item %d: %s", stage, item.index, e)
+        item.error = e
+        item.failed_stage = stage
+
+
+async def run_pipeline(payloads, download, process, upload, on_error=None, cleanup=None,
+                       download_concurrency=1, process_concurrency=1, upload_concurrency=1, queue_size=1):
+    """
+    Runs every payload through three overlapping stages: download -> process -> upload.
+    Each stage is an async callback taking a PipelineItem and has its own concurrency
+    limit. Bounded queues of queue_size items between stages provide backpressure, so
+    downloads never run far ahead of processing. At most process_concurrency +
+    upload_concurrency + queue_size items are between the start of their download and
+    their cleanup, so processing cannot run far ahead of a slow upload either.
+
+    Items enter the upload stage strictly in submission order; with upload_concurrency=1
+    they are also delivered in that order. Failed items are passed to on_error(item) in
+    their upload slot instead of upload(). cleanup(item) runs once for every item, also
+    when the pipeline is aborted. A stage raising asyncio.CancelledError aborts the
+    whole pipeline and the CancelledError is re-raised.
+
+    Returns the list of PipelineItems in submission order.
+    """
+    items = [PipelineItem(index, payload) for index, payload in enumerate(payloads)]
+    download_queue = asyncio.Queue()
+    process_queue = asyncio.Queue(maxsize=max(1, queue_size))
+    upload_queue = asyncio.Queue(maxsize=max(1, queue_size))
+    for item in items:
+        download_queue.put_nowait(item)
+    in_flight = asyncio.Semaphore(max(1, process_concurrency) + max(1, upload_concurrency) + max(1, queue_size))
+    admitted = set()  # indexes of items holding an in_flight slot
+
+    async def finish(item):
+        if item.index in admitted:
+            admitted.discard(item.index)
+            in_flight.release()
+        if cleanup is not None and not item.cleaned_up:
+            item.cleaned_up = True
+            try:
+                await cleanup(item)
+            except Exception as e:
+                logger.warning("Pipeline cleanup failed for item %d: %s", item.index, e)
+
+    async def download_worker():
+        while True:
+            # Items are admitted in submission order, so the next one to upload always has a slot.
+            await in_flight.acquire()
+            if download_queue.empty():
+                in_flight.release()
+                return
+            item = download_queue.get_nowait()
+            admitted.add(item.index)
+            await _run_stage(item, STAGE_DOWNLOAD, download)
+            await process_queue.put(item)
+
+    async def process_worker():
+        while True:
+            item = await process_queue.get()
+            if item is None:
+                return
+            await _run_stage(item, STAGE_PROCESS, process)
+            item.processed.set()
+
+    async def sequencer():
+        # Releases processed items to the upload stage in submission order.
+        for item in items:
+            await item.processed.wait()
+            await upload_queue.put(item)
+
+    async def upload_worker():
+        while True:
+            item = await upload_queue.get()
+            if item is None:
+                return
+            if item.error is None:
+                await _run_stage(item, STAGE_UPLOAD, upload)
+            if item.error is not None and on_error is not None:
+                try:
+                    await on_error(item)
+                except Exception as e:
+                    logger.warning("Pipeline error report failed for item %d: %s", item.index, e)
+            await finish(item)
+
+    async def run_downloads():
+        await asyncio.gather(*(download_worker() for _ in range(max(1, download_concurrency))))
+        for _ in range(max(1, process_concurrency)):
+            await process_queue.put(None)
+
+    async def run_uploads():
+        await sequencer()
+        for _ in range(max(1, upload_concurrency)):
+            await upload_queue.put(None)
+
+    tasks = [asyncio.ensure_future(run_downloads()), asyncio.ensure_future(run_uploads())]
+    tasks += [asyncio.ensure_future(process_worker()) for _ in range(max(1, process_concurrency))]
+    tasks += [asyncio.ensure_future(upload_worker()) for _ in range(max(1, upload_concurrency))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        for item in items:
+            await finish(item)
+    return items
@@ -0,0 +1,203 @@
+import os
+import re
+import glob
+import time
+import functools
+import logging
+
+from PIL import Image, ImageDraw, ImageFont
+import fitz  # PyMuPDF
+
+from config import PREVIEW_MAX_PX, PREVIEW_MIN_DPI, PREVIEW_MAX_DPI
+from metrics import PHASE_RENDER, timed
+from geometry import normalized_rect
+
+logger = logging.getLogger(__name__)
+
+_REFERENCE = re.compile(r"(\d+) \d+ R\b")
+_PARENT = re.compile(r"/Parent\s+\d+ \d+ R\b")
+
+class IncompletePreviewError(Exception):
+    """Raised when page 1 cannot be drawn completely from a partially downloaded PDF."""
+
+def preview_dpi(page_rect):
+    """
+    Picks a rendering DPI so the longer side of the page is at most PREVIEW_MAX_PX pixels,
+    within PREVIEW_MIN_DPI..PREVIEW_MAX_DPI. A grid preview does not need print resolution.
+    """
+    longest = max(page_rect.width, page_rect.height) or 1
+    dpi = int(PREVIEW_MAX_PX * 72 / longest)
+    return max(PREVIEW_MIN_DPI, min(PREVIEW_MAX_DPI, dpi))
+
+def grid_cache_path(cache_dir, file_unique_id, dpi):
+    return os.path.join(cache_dir, f"{file_unique_id}-{dpi}dpi.jpg")
+
+def find_cached_grid(cache_dir, file_unique_id):
+    """
+    Returns the path of a cached annotated grid for the file, or None.
+    """
+    if not cache_dir or not file_unique_id:
+        return None
+    matches = sorted(glob.glob(os.path.join(cache_dir, glob.escape(file_unique_id) + "-*dpi.jpg")))
+    if not matches:
+        return None
+    try:
+        os.utime(matches[0])  # a hit counts as a use for prune_grid_cache
+    except OSError:
+        return None
+    return matches[0]
+
+def prune_grid_cache(cache_dir, max_bytes, max_age_seconds):
+    """
+    Removes cached grids not used for max_age_seconds, then the least recently used
+    ones until the grids take at most max_bytes. Returns the number removed.
+    """
+    entries = []
+    for path in glob.glob(os.path.join(glob.escape(cache_dir), "*dpi.jpg")):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for mtime, size, path in entries:
+        if mtime >= cutoff and total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    if removed:
+        logger.info("Preview cache pruned %d grid(s)", removed)
+    return removed
+
+def _existing_object(doc, xref):
+    """
+    Returns the source of object xref, raising IncompletePreviewError if the object or
+    its stream data is not in the file (MuPDF repairs a truncated PDF without it).
+    """
+    try:
+        if 0 < xref < doc.xref_length():
+            source = doc.xref_object(xref, compressed=True)
+            if source != "null":
+                if doc.xref_is_stream(xref):
+                    doc.xref_stream_raw(xref)
+                return source
+    except Exception:
+        pass
+    raise IncompletePreviewError(f"object {xref} is beyond the downloaded part of the PDF")
+
+def _check_first_page_complete(doc, page):
+    """
+    For a partially downloaded PDF: raises IncompletePreviewError unless page is the
+    document's real first page and every object it is drawn from (contents, resources
+    and whatever they reference) was downloaded. Without these checks MuPDF renders the
+    missing parts as a blank page and raises nothing.
+    """
+    kind, value = doc.xref_get_key(doc.pdf_catalog(), "Pages")
+    node = int(value.split()[0]) if kind == "xref" else 0
+    while _existing_object(doc, node) and doc.xref_get_key(node, "Type")[1] == "/Pages":
+        kind, kids = doc.xref_get_key(node, "Kids")
+        first = _REFERENCE.search(kids) if kind == "array" else None
+        if first is None:
+            raise IncompletePreviewError("the page tree is incomplete")
+        node = int(first.group(1))
+    if node != page.xref:
+        raise IncompletePreviewError("the first page is beyond the downloaded part of the PDF")
+    pending, seen = [page.xref], set()
+    while pending:
+        xref = pending.pop()
+        if xref not in seen:
+            seen.add(xref)
+            source = _PARENT.sub("", _existing_object(doc, xref))
+            pending.extend(int(number) for number in _REFERENCE.findall(source))
+
+def _render_first_page(page, dpi):
+    scale = dpi / 72
+    with timed(PHASE_RENDER):
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale))
+        return Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+@functools.lru_cache(maxsize=None)
+def _grid_font():
+    """
+    Returns the font for the grid labels, loaded once per process: Arial where it is
+    installed, otherwise Pillow's default font.
+    """
+    try:
+        return ImageFont.truetype("arial.ttf", 12)
+    except Exception:
+        return ImageFont.load_default()
+
+def annotate_first_page_image(pdf_path, dpi=None, output_path=None, partial=False):
+    """
+    Opens the PDF's first page using PyMuPDF, renders it as an image,
+    and draws a blue border with tick marks and normalized coordinate labels (0–10)
+    along the top (x axis) and left (y axis) edges.
+    dpi defaults to preview_dpi(); output_path defaults to "<pdf name>_annotated.jpg" and may
+    contain "{dpi}", which is filled in with the DPI used. With partial, pdf_path is the
+    start of a larger file and IncompletePreviewError is raised if page 1 is not all in it.
+    Returns the path of the annotated image.
+    """
+    logger.info("Annotating first page of PDF: %s", pdf_path)
+    with fitz.open(pdf_path) as doc:
+        page = doc[0]
+        if partial:
+            _check_first_page_complete(doc, page)
+        if dpi is None:
+            dpi = preview_dpi(page.rect)
+        image = _render_first_page(page, dpi)
+
+    draw = ImageDraw.Draw(image)
+    font = _grid_font()
+
+    img_width, img_height = image.size
+
+    # Draw blue border.
+    draw.rectangle([0, 0, img_width-1, img_height-1], outline="blue", width=2)
+
+    # Draw tick marks along the top edge (horizontal scale 0 to 10).
+    for i in range(11):
+        x = (i/10) * img_width
+        draw.line([(x, 0), (x, 10)], fill="blue", width=2)
+        draw.text((x+2, 12), f"{i}", fill="blue", font=font)
+
+    # Draw tick marks along the left edge (vertical scale 0 to 10).
+    for i in range(11):
+        y = (i/10) * img_height
+        draw.line([(0, y), (10, y)], fill="blue", width=2)
+        draw.text((12, y-6), f"{i}", fill="blue", font=font)
+
+    if output_path is None:
+        output_path = os.path.splitext(pdf_path)[0] + "_annotated.jpg"
+    annotated_path = output_path.format(dpi=dpi)
+    os.makedirs(os.path.dirname(annotated_path) or ".", exist_ok=True)
+    image.save(annotated_path + ".tmp", format="JPEG")
+    os.replace(annotated_path + ".tmp", annotated_path)
+    logger.info("Annotated image saved: %s (%d dpi)", annotated_path, dpi)
+    return annotated_path
+
+def render_cover_preview(pdf_path, cover_coords, output_path, dpi=None, partial=False):
+    """
+    Renders the first page with the Sides Cover-Up rectangle outlined in red, using the
+    same rectangle computation as the real job, so the user can check it before the
+    whole document is processed. The document itself is not modified. partial is as
+    for annotate_first_page_image.
+    Returns output_path.
+    """
+    with fitz.open(pdf_path) as doc:
+        page = doc[0]
+        if partial:
+            _check_first_page_complete(doc, page)
+        if dpi is None:
+            dpi = preview_dpi(page.rect)
+        rect = normalized_rect(page, cover_coords)
+        page.draw_rect(rect, color=(1, 0, 0), fill=(1, 0, 0), fill_opacity=0.25, width=2)
+        image = _render_first_page(page, dpi)
+    image.save(output_path, format="JPEG")
+    return output_path
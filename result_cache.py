@@ -0,0 +1,178 @@
+import os
+import time
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import config
+from sqlite_db import connect
+
+logger = logging.getLogger(__name__)
+
+# Bump when a change to the rendering code makes previously cached outputs stale.
+CACHE_VERSION = 1
+
+# Settings from the environment that change what an output looks like; they are part of
+# every key, so outputs made under other settings are not served after a change.
+OUTPUT_SETTINGS = ("STAMP_ENGINE", "COVER_MODE", "REDACT_IMAGES", "TEXT_LAYER_MIN_WORDS",
+                   "SCANNED_PAGE_IMAGE_COVERAGE", "TEXT_LAYER_MIN_COVERAGE", "OCR_PAGES_PER_SHARD",
+                   "OCR_DPI", "OCR_GRAYSCALE", "OCR_ADAPTIVE_DPI", "OCR_MIN_DPI", "OCR_MAX_DPI",
+                   "OCR_TARGET_TEXT_PX", "OCR_RERUN_FACTOR", "OCR_PSM", "OCR_LANG", "OCR_WHITELIST",
+                   "OUTPUT_GARBAGE", "OUTPUT_DEFLATE", "OUTPUT_OBJECT_STREAMS", "OUTPUT_IMAGE_QUALITY",
+                   "OUTPUT_IMAGE_DPI")
+
+
+class CacheEntry:
+    """A cached watermarked PDF: its path on disk and, once uploaded, its Telegram file_id."""
+
+    def __init__(self, key, path, telegram_file_id):
+        self.key = key
+        self.path = path
+        self.telegram_file_id = telegram_file_id
+
+
+class ResultCache:
+    """
+    Disk-backed LRU cache of watermarked PDFs, keyed on the Telegram file identity plus
+    the full watermark parameter set and the OUTPUT_SETTINGS in effect.
+
+    Outputs are stored as files in `directory`; an SQLite index next to them tracks size,
+    age, last access and hit/miss counters. SQLite locking and atomic file renames make it
+    safe to share between several worker processes. Entries older than max_age_seconds
+    are dropped, then least recently used entries until the cache fits in max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes, max_age_seconds):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        os.makedirs(directory, exist_ok=True)
+        self._db_path = os.path.join(directory, "index.sqlite3")
+        with connect(self._db_path) as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY, file_name TEXT NOT NULL, size INTEGER NOT NULL,
+                created REAL NOT NULL, last_access REAL NOT NULL, telegram_file_id TEXT)""")
+            db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            db.execute("INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0)")
+
+    @staticmethod
+    def make_key(file_unique_id, params):
+        """
+        Builds the cache key from a Telegram file_unique_id, a dict of watermark parameters
+        and the current OUTPUT_SETTINGS.
+        """
+        settings = {name: getattr(config, name) for name in OUTPUT_SETTINGS}
+        encoded = json.dumps({"version": CACHE_VERSION, "file": file_unique_id, "params": params,
+                              "settings": settings}, sort_keys=True, default=str)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def _count(self, db, name):
+        db.execute("UPDATE counters SET value = value + 1 WHERE name = ?", (name,))
+
+    def get(self, key):
+        """
+        Returns the CacheEntry for key, or None on a miss. A hit refreshes the entry's LRU position.
+        """
+        now = time.time()
+        with connect(self._db_path) as db:
+            row = db.execute("SELECT file_name, created, telegram_file_id FROM entries WHERE key = ?",
+                             (key,)).fetchone()
+            if row is not None:
+                file_name, created, telegram_file_id = row
+                path = os.path.join(self.directory, file_name)
+                if now - created <= self.max_age_seconds and os.path.exists(path):
+                    db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                    self._count(db, "hits")
+                    logger.info("Result cache hit for %s", key)
+                    return CacheEntry(key, path, telegram_file_id)
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._remove_file(file_name)
+            self._count(db, "misses")
+        logger.debug("Result cache miss for %s", key)
+        return None
+
+    def put(self, key, source_path):
+        """
+        Stores a finished output under key (hard-linked when possible, otherwise copied)
+        and evicts old entries. An output held in memory may be passed as bytes.
+        Returns the new CacheEntry.
+        """
+        file_name = key + ".pdf"
+        path = os.path.join(self.directory, file_name)
+        # A name of its own, as consumers in this process may store the same key at once.
+        fd, temp_path = tempfile.mkstemp(prefix=file_name + ".", suffix=".tmp", dir=self.directory)
+        try:
+            if isinstance(source_path, (bytes, bytearray)):
+                with os.fdopen(fd, "wb") as f:
+                    f.write(source_path)
+            else:
+                os.close(fd)
+                try:
+                    # Linked beside the reserved name first, as a link cannot replace a file.
+                    os.link(source_path, temp_path + ".link")
+                    os.replace(temp_path + ".link", temp_path)
+                except OSError:
+                    shutil.copyfile(source_path, temp_path)
+            os.replace(temp_path, path)
+        finally:
+            # Left over after a failure, or when path already was a link to the same file
+            # (renaming between two links of one file leaves both in place).
+            for leftover in (temp_path, temp_path + ".link"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        now = time.time()
+        with connect(self._db_path) as db:
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, NULL)",
+                       (key, file_name, os.path.getsize(path), now, now))
+        self.evict()
+        return CacheEntry(key, path, None)
+
+    def set_telegram_file_id(self, key, telegram_file_id):
+        """
+        Records the file_id of an uploaded output so later hits can be re-sent without uploading.
+        """
+        with connect(self._db_path) as db:
+            db.execute("UPDATE entries SET telegram_file_id = ? WHERE key = ?", (telegram_file_id, key))
+
+    def evict(self):
+        """
+        Removes expired entries, then least recently used ones until the cache fits in max_bytes.
+        """
+        now = time.time()
+        with connect(self._db_path) as db:
+            expired = db.execute("SELECT key, file_name FROM entries WHERE created < ?",
+                                 (now - self.max_age_seconds,)).fetchall()
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE created >= ?",
+                               (now - self.max_age_seconds,)).fetchone()[0]
+            victims = list(expired)
+            if total > self.max_bytes:
+                for key, file_name, size in db.execute(
+                        "SELECT key, file_name, size FROM entries WHERE created >= ? ORDER BY last_access",
+                        (now - self.max_age_seconds,)).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    victims.append((key, file_name))
+                    total -= size
+            for key, file_name in victims:
+                db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._remove_file(file_name)
+        if victims:
+            logger.info("Result cache evicted %d entr(ies)", len(victims))
+
+    def _remove_file(self, file_name):
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """
+        Returns hit/miss counters and the current size of the cache.
+        """
+        with connect(self._db_path) as db:
+            counters = dict(db.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"hits": counters.get("hits", 0), "misses": counters.get("misses", 0),
+                "entries": entries, "bytes": size}
@@ -0,0 +1,148 @@
+import time
+import json
+import uuid
+import logging
+
+from sqlite_db import connect
+
+logger = logging.getLogger(__name__)
+
+
+def new_session(**fields):
+    """
+    Returns a new conversation session. Every session gets a unique "id", so a handler
+    that still holds an old session can tell that the chat has started a new one.
+    """
+    session = {"id": uuid.uuid4().hex}
+    session.update(fields)
+    return session
+
+
+class MemorySessionStore:
+    """
+    Keeps conversation sessions in this process's memory, as the bot originally did.
+    Sessions not updated for ttl_seconds are dropped by expire().
+    """
+
+    def __init__(self, ttl_seconds):
+        self.ttl_seconds = ttl_seconds
+        self._sessions = {}  # chat_id -> (session, expires)
+
+    def get(self, chat_id):
+        entry = self._sessions.get(chat_id)
+        if entry is None or entry[1] < time.time():
+            return None
+        return entry[0]
+
+    def put(self, chat_id, session):
+        """
+        Stores session as the chat's current session, replacing any other.
+        """
+        self._sessions[chat_id] = (session, time.time() + self.ttl_seconds)
+
+    def update(self, chat_id, session):
+        """
+        Saves session if it is still the chat's current session. Returns False when the
+        chat has meanwhile started a new session or the session was deleted.
+        """
+        entry = self._sessions.get(chat_id)
+        if entry is None or entry[0]["id"] != session["id"]:
+            return False
+        self.put(chat_id, session)
+        return True
+
+    def delete(self, chat_id, session_id=None):
+        """
+        Removes the chat's session; with session_id, only if it is still that session.
+        """
+        entry = self._sessions.get(chat_id)
+        if entry is not None and (session_id is None or entry[0]["id"] == session_id):
+            del self._sessions[chat_id]
+
+    def expire(self):
+        """
+        Removes sessions past their TTL and returns them, so their files can be cleaned up.
+        """
+        now = time.time()
+        expired = [chat_id for chat_id, (_, expires) in list(self._sessions.items()) if expires < now]
+        return [self._sessions.pop(chat_id)[0] for chat_id in expired]
+
+    def count(self):
+        return len(self._sessions)
+
+
+class SQLiteSessionStore:
+    """
+    Keeps conversation sessions as JSON in an SQLite database, so they survive a restart
+    and can be read by every bot process on the host. Sessions must be JSON-serialisable
+    (tuples come back as lists). Sessions not updated for ttl_seconds are dropped by expire().
+    """
+
+    def __init__(self, db_path, ttl_seconds):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        with connect(self.db_path) as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                chat_id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, data TEXT NOT NULL,
+                expires REAL NOT NULL)""")
+
+    def get(self, chat_id):
+        with connect(self.db_path) as db:
+            row = db.execute("SELECT data FROM sessions WHERE chat_id = ? AND expires >= ?",
+                             (chat_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, chat_id, session):
+        """
+        Stores session as the chat's current session, replacing any other.
+        """
+        with connect(self.db_path) as db:
+            db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                       (chat_id, session["id"], json.dumps(session), time.time() + self.ttl_seconds))
+
+    def update(self, chat_id, session):
+        """
+        Saves session if it is still the chat's current session. Returns False when the
+        chat has meanwhile started a new session or the session was deleted.
+        """
+        with connect(self.db_path) as db:
+            cursor = db.execute(
+                "UPDATE sessions SET data = ?, expires = ? WHERE chat_id = ? AND session_id = ?",
+                (json.dumps(session), time.time() + self.ttl_seconds, chat_id, session["id"]))
+            return cursor.rowcount > 0
+
+    def delete(self, chat_id, session_id=None):
+        """
+        Removes the chat's session; with session_id, only if it is still that session.
+        """
+        with connect(self.db_path) as db:
+            if session_id is None:
+                db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+            else:
+                db.execute("DELETE FROM sessions WHERE chat_id = ? AND session_id = ?", (chat_id, session_id))
+
+    def expire(self):
+        """
+        Removes sessions past their TTL and returns them, so their files can be cleaned up.
+        """
+        now = time.time()
+        with connect(self.db_path) as db:
+            # Lock before reading, so a session refreshed meanwhile is neither returned nor deleted.
+            db.execute("BEGIN IMMEDIATE")
+            rows = db.execute("SELECT data FROM sessions WHERE expires < ?", (now,)).fetchall()
+            db.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+        return [json.loads(row[0]) for row in rows]
+
+    def count(self):
+        with connect(self.db_path) as db:
+            return db.execute("SELECT COUNT(*) FROM sessions WHERE expires >= ?", (time.time(),)).fetchone()[0]
+
+
+def open_session_store(path, ttl_seconds):
+    """
+    Returns an SQLiteSessionStore at path, or a MemorySessionStore when path is empty.
+    """
+    if path:
+        logger.info("Using SQLite session store at %s", path)
+        return SQLiteSessionStore(path, ttl_seconds)
+    return MemorySessionStore(ttl_seconds)
@@ -0,0 +1,19 @@
+import sqlite3
+from contextlib import contextmanager
+
+
+@contextmanager
+def connect(db_path, timeout=30):
+    """
+    Opens the SQLite database at db_path in WAL mode, so readers do not block the
+    writer, for one transaction: it is committed when the block exits, rolled back if
+    it raises, and the connection is closed either way. A locked database is waited
+    on for up to timeout seconds.
+    """
+    db = sqlite3.connect(db_path, timeout=timeout)
+    try:
+        db.execute("PRAGMA journal_mode=WAL")
+        with db:
+            yield db
+    finally:
+        db.close()
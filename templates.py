@@ -0,0 +1,190 @@
+import logging
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+
+from config import TEMPLATE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+_compiled = OrderedDict()  # key -> one-page template PDF as bytes, least recently used first
+
+
+def _tag_fonts(template):
+    """
+    Gives every font of a template PDF a /Name of its own. Templates built with PyMuPDF
+    use the same Helvetica dictionary as PDFs written by PyMuPDF; copied into such a
+    document it would be a duplicate object, and finding any duplicate makes MuPDF's
+    garbage collection (OUTPUT_GARBAGE 3 and up) repeat its whole deduplication pass,
+    which doubles the save time of large files.
+    """
+    with fitz.open("pdf", template) as doc:
+        for xref in range(1, doc.xref_length()):
+            if doc.xref_get_key(xref, "Type")[1] == "/Font":
+                doc.xref_set_key(xref, "Name", f"/PdfwmFont{xref}")
+        return doc.tobytes()
+
+
+def compiled_template(key, build):
+    """
+    Returns the one-page template PDF (bytes) for key, calling build() only the first
+    time key is seen in this process; the bytes are cached exactly as build() returned
+    them. The TEMPLATE_CACHE_SIZE most recently used templates are kept, so every file
+    of a batch handled by the same worker reuses them.
+    """
+    template = _compiled.get(key)
+    if template is not None:
+        _compiled.move_to_end(key)
+        return template
+    template = build()
+    _compiled[key] = template
+    while len(_compiled) > max(1, TEMPLATE_CACHE_SIZE):
+        _compiled.popitem(last=False)
+    logger.debug("Compiled template %s (%d bytes)", key, len(template))
+    return template
+
+
+def _pdf_number(value):
+    return f"{value:.4f}".rstrip("0").rstrip(".")
+
+
+def _resources_holder(doc, page):
+    """
+    Returns (xref, key prefix) of the dictionary holding the page's /Resources entries.
+    Resources inherited from the page tree are first copied onto the page itself.
+    """
+    kind, value = doc.xref_get_key(page.xref, "Resources")
+    if kind == "null":
+        xref = page.xref
+        while kind == "null":
+            parent_kind, parent = doc.xref_get_key(xref, "Parent")
+            if parent_kind != "xref":
+                value = "<<>>"
+                break
+            xref = int(parent.split()[0])
+            kind, value = doc.xref_get_key(xref, "Resources")
+        doc.xref_set_key(page.xref, "Resources", value)
+        kind = "xref" if value.endswith(" R") else "dict"
+    if kind == "xref":
+        return int(value.split()[0]), ""
+    return page.xref, "Resources/"
+
+
+def _xobjects_holder(doc, page):
+    """
+    Returns (xref, key prefix) of the dictionary holding the page's XObject names.
+    """
+    holder, prefix = _resources_holder(doc, page)
+    kind, value = doc.xref_get_key(holder, prefix + "XObject")
+    if kind == "xref":
+        return int(value.split()[0]), ""
+    return holder, prefix + "XObject/"
+
+
+def _add_xobject(doc, page, name, xref):
+    holder, prefix = _xobjects_holder(doc, page)
+    doc.xref_set_key(holder, prefix + name, f"{xref} 0 R")
+
+
+def _shown_form_xref(doc, page):
+    """
+    Returns the xref of the Form XObject that show_pdf_page has just drawn on the page:
+    the positioned form named in the page's last content stream (show_pdf_page itself
+    returns the xref of the unpositioned one inside it).
+    """
+    name = doc.xref_stream(page.get_contents()[-1]).split()[1].decode().lstrip("/")
+    holder, prefix = _xobjects_holder(doc, page)
+    return int(doc.xref_get_key(holder, prefix + name)[1].split()[0])
+
+
+def _append_contents(doc, page, operators, streams=None):
+    """
+    Appends operators to the page as a content stream, drawn after the existing ones.
+    With a streams dict (operators -> xref), pages appending the same operators share
+    one stream object.
+    """
+    if not page.is_wrapped:
+        page.wrap_contents()
+    stream_xref = streams.get(operators) if streams is not None else None
+    if stream_xref is None:
+        stream_xref = doc.get_new_xref()
+        doc.update_object(stream_xref, "<<>>")
+        doc.update_stream(stream_xref, operators.encode(), new=True)
+        if streams is not None:
+            streams[operators] = stream_xref
+    kind, value = doc.xref_get_key(page.xref, "Contents")
+    if kind == "xref" and not doc.xref_is_stream(int(value.split()[0])):
+        kind, value = "array", doc.xref_object(int(value.split()[0]), compressed=True)
+    if kind == "array":
+        contents = value.strip()[1:-1].strip()
+    elif kind == "xref":
+        contents = value
+    else:
+        contents = ""
+    doc.xref_set_key(page.xref, "Contents", f"[{contents} {stream_xref} 0 R]")
+
+
+class TemplateStamper:
+    """
+    Stamps compiled templates onto the pages of one document.
+
+    The first time a template is placed, show_pdf_page copies its content and fonts into
+    the document as a Form XObject. Every later placement, on any page of the document,
+    only references that XObject from a small content stream, moved with a "cm" where the
+    position differs; pages needing the same stream share it. Pages therefore share one
+    copy of the watermark's content stream and font instead of each getting their own,
+    and stamping a page does not rescan its resources. A stamper survives the document
+    being reopened between chunks, as it only keeps xrefs.
+    """
+
+    def __init__(self):
+        self._templates = {}  # key -> open template document
+        self._forms = {}  # key -> (xref of the Form XObject, PDF position it was placed at)
+        self._streams = {}  # operators -> xref of a content stream already holding them
+
+    def _template(self, key, build):
+        if key not in self._templates:
+            template = compiled_template(("stamped", key), lambda: _tag_fonts(build()))
+            self._templates[key] = fitz.open("pdf", template)
+        return self._templates[key]
+
+    @staticmethod
+    def _pdf_origin(page, rect):
+        return fitz.Point(rect.x0, rect.y1) * ~page.transformation_matrix
+
+    def stamp(self, page, key, build, rects, rotate=0, cover=()):
+        """
+        Places the template for key (built by build() if it is not compiled yet) at every
+        rect of rects, given in unrotated page coordinates like show_pdf_page's rect. All
+        rects placed for one key must have the same size, and rotate must be the same for
+        the key. The rects of cover are first filled with white, underneath the template.
+        """
+        doc = page.parent
+        rects = list(rects)
+        operators = []
+        for rect in cover:
+            r = rect * ~page.transformation_matrix
+            operators.append("1 1 1 rg 1 1 1 RG {} {} {} {} re B".format(
+                *(_pdf_number(v) for v in (r.x0, r.y0, r.width, r.height))))
+        if key not in self._forms and rects:
+            if operators:
+                _append_contents(doc, page, "q\n" + "\n".join(operators) + "\nQ\n")
+                operators = []
+            rect = rects.pop(0)
+            page.show_pdf_page(rect, self._template(key, build), 0, rotate=rotate)
+            self._forms[key] = (_shown_form_xref(doc, page), self._pdf_origin(page, rect))
+        if rects:
+            xref, origin = self._forms[key]
+            name = f"PdfwmTpl{xref}"
+            _add_xobject(doc, page, name, xref)
+            for rect in rects:
+                offset = self._pdf_origin(page, rect) - origin
+                operators.append("q 1 0 0 1 {} {} cm /{} Do Q".format(
+                    _pdf_number(offset.x), _pdf_number(offset.y), name))
+        if operators:
+            _append_contents(doc, page, "q\n" + "\n".join(operators) + "\nQ\n", self._streams)
+
+    def close(self):
+        for template in self._templates.values():
+            template.close()
+        self._templates.clear()
@@ -0,0 +1,106 @@
+import time
+import random
+import asyncio
+import logging
+
+from pyrogram.errors import FloodWait, InternalServerError
+
+from metrics import PHASE_UPLOAD, timed
+
+logger = logging.getLogger(__name__)
+
+# Errors after which an upload is worth retrying; anything else fails at once.
+RETRYABLE_ERRORS = (FloodWait, InternalServerError, ConnectionError, TimeoutError, asyncio.TimeoutError)
+
+
+class UploadTooLargeError(Exception):
+    """Raised for a file above the Telegram upload size limit."""
+
+
+class UploadScheduler:
+    """
+    Runs the uploads of every job in the bot process within Telegram's limits.
+
+    At most max_parallel uploads run at once, and together they may hold at most
+    max_inflight_bytes, so several large files are not pushed through the connection at
+    the same time; a file larger than that budget runs on its own. Files above
+    max_file_bytes are refused before anything is sent.
+
+    A FloodWait pauses every upload for the number of seconds Telegram asks for, as the
+    limit applies to the whole account; other retryable errors back off exponentially
+    from backoff_seconds. An upload is attempted at most retries + 1 times.
+    """
+
+    def __init__(self, max_parallel, max_inflight_bytes, max_file_bytes, retries, backoff_seconds):
+        self.max_parallel = max(1, max_parallel)
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_file_bytes = max_file_bytes
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+        self._condition = None  # created on first use, inside the running event loop
+        self._active = 0
+        self._inflight_bytes = 0
+        self._paused_until = 0.0
+
+    @property
+    def active(self):
+        return self._active
+
+    def _can_start(self, size):
+        if self._active == 0:
+            return True
+        return self._active < self.max_parallel and self._inflight_bytes + size <= self.max_inflight_bytes
+
+    async def _acquire(self, size):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            async with self._condition:
+                await self._condition.wait_for(lambda: self._can_start(size))
+                if self._paused_until <= time.monotonic():
+                    self._active += 1
+                    self._inflight_bytes += size
+                    return
+
+    async def _release(self, size):
+        async with self._condition:
+            self._active -= 1
+            self._inflight_bytes -= size
+            self._condition.notify_all()
+
+    async def send(self, send, size, name):
+        """
+        Uploads a file of size bytes by awaiting send(), which must start the upload
+        afresh each time it is called. Returns (send()'s result, seconds spent sending
+        the attempt that succeeded). Raises UploadTooLargeError, or the last error once
+        the retries are used up.
+        """
+        if self.max_file_bytes and size > self.max_file_bytes:
+            raise UploadTooLargeError(f"{name} is {size / (1024 * 1024):.0f} MB, above the "
+                                      f"{self.max_file_bytes / (1024 * 1024):.0f} MB upload limit")
+        attempt = 0
+        while True:
+            await self._acquire(size)
+            started = time.perf_counter()
+            try:
+                with timed(PHASE_UPLOAD):
+                    result = await send()
+                return result, time.perf_counter() - started
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.retries:
+                    raise
+                if isinstance(e, FloodWait):
+                    delay = float(e.value) + 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                    logger.warning("FloodWait while uploading %s; pausing uploads for %.0fs", name, delay)
+                else:
+                    delay = self.backoff_seconds * 2 ** attempt * (1 + random.random() / 2)
+                    logger.warning("Upload of %s failed (%s); retrying in %.1fs", name, e, delay)
+            finally:
+                await self._release(size)
+            attempt += 1
+            await asyncio.sleep(delay)
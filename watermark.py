@@ -0,0 +1,386 @@
+import os
+import shutil
+import logging
+from io import BytesIO
+
+from PyPDF2 import PdfReader, PdfWriter
+from reportlab.pdfgen import canvas
+from reportlab.lib.colors import red, black, white
+
+import fitz  # PyMuPDF
+
+from config import STAMP_ENGINE, COVER_MODE, REDACT_IMAGES, STREAM_CHUNK_PAGES, MAX_MEMORY_MB, OUTPUT_GARBAGE, OUTPUT_DEFLATE
+from optimize import write_output
+from geometry import normalized_rect, normalized_visible_rect
+from templates import TemplateStamper, compiled_template
+from workspace import open_pdf, output_name
+from metrics import PHASE_DRAW, PHASE_SAVE, COUNTER_PAGES, COUNTER_REDACTIONS, timed, count
+from ocr import METHOD_TEXT, METHOD_OCR, METHOD_OCR_INDEX, find_text_boxes, ocr_settings
+
+logger = logging.getLogger(__name__)
+
+# Watermark colours offered to the user, by name.
+COLOR_MAPPING = {"red": red, "black": black, "white": white}
+
+# Cover-Up modes (see COVER_MODE) and what redaction does to images under an area.
+COVER_MODES = ("cover", "redact")
+REDACT_IMAGE_MODES = {
+    "keep": fitz.PDF_REDACT_IMAGE_NONE,
+    "blank": fitz.PDF_REDACT_IMAGE_PIXELS,
+    "remove": fitz.PDF_REDACT_IMAGE_REMOVE,
+}
+
+def standard_watermark_position(location, page_width, page_height, text_size):
+    """
+    Returns (x, y, rotation) of the watermark text for locations 1-8, in ReportLab
+    coordinates (origin at the bottom-left of a page_width x page_height page).
+    """
+    margin = 10
+    x, y = 0, 0
+    rotation = 0
+    if location == 1:
+        x = page_width - margin - 100
+        y = page_height - margin - text_size
+    elif location == 2:
+        x = (page_width / 2) - 50
+        y = page_height - margin - text_size
+    elif location == 3:
+        x = margin
+        y = page_height - margin - text_size
+    elif location == 4:
+        x = (page_width / 2) - 50
+        y = (page_height / 2) - (text_size / 2)
+    elif location == 5:
+        x = (page_width / 2) - 50
+        y = (page_height / 2) - (text_size / 2)
+        rotation = 45
+    elif location == 6:
+        x = page_width - margin - 100
+        y = margin
+    elif location == 7:
+        x = (page_width / 2) - 50
+        y = margin
+    elif location == 8:
+        x = margin
+        y = margin
+    return x, y, rotation
+
+def render_watermark_overlay(watermark_text, text_size, color, location, page_width, page_height):
+    """
+    Draws the standard watermark on an otherwise empty page of the given size
+    with ReportLab and returns the one-page PDF as bytes.
+    """
+    watermark_stream = BytesIO()
+    c = canvas.Canvas(watermark_stream, pagesize=(page_width, page_height))
+    c.setFont("Helvetica", text_size)
+    c.setFillColor(color)
+    x, y, rotation = standard_watermark_position(location, page_width, page_height, text_size)
+    if rotation:
+        c.saveState()
+        c.translate(x, y)
+        c.rotate(rotation)
+        c.drawString(0, 0, watermark_text)
+        c.restoreState()
+    else:
+        c.drawString(x, y, watermark_text)
+    c.save()
+    return watermark_stream.getvalue()
+
+def _color_key(color):
+    return (color.red, color.green, color.blue)
+
+def standard_template(watermark_text, text_size, color, location, page_width, page_height):
+    """
+    Returns the locations 1-8 overlay for a page_width x page_height page, rendered
+    once per worker process for each parameter set (used by the legacy engine).
+    """
+    key = ("standard", watermark_text, text_size, _color_key(color), location,
+           round(page_width, 2), round(page_height, 2))
+    return compiled_template(key, lambda: render_watermark_overlay(
+        watermark_text, text_size, color, location, page_width, page_height))
+
+def render_sides_template(watermark_text, text_size, color, cover_coords, page_width, page_height):
+    """
+    Draws the Sides Cover-Up for an upright page_width x page_height page: the normalized
+    cover_coords region filled with white and the watermark text centred in it.
+    Returns the one-page PDF as bytes.
+    """
+    with fitz.open() as doc:
+        page = doc.new_page(width=page_width, height=page_height)
+        rect = normalized_visible_rect(page, cover_coords)
+        page.draw_rect(rect, color=(1, 1, 1), fill=(1, 1, 1))
+        center_x = (rect.x0 + rect.x1) / 2
+        center_y = (rect.y0 + rect.y1) / 2
+        text_box = fitz.Rect(center_x - 100, center_y - text_size, center_x + 100, center_y + text_size)
+        page.insert_textbox(text_box, watermark_text, fontsize=text_size, color=_color_key(color), align=1)
+        return doc.tobytes(garbage=OUTPUT_GARBAGE, deflate=OUTPUT_DEFLATE)
+
+def cover_text_template(watermark_text, text_size, color):
+    """
+    Returns (key, build, width, height, baseline) of the template holding just the
+    watermark text that Cover-Up writes under each match; baseline is the distance from
+    the template's top to the text baseline.
+    """
+    width = fitz.get_text_length(watermark_text, fontname="helv", fontsize=text_size) + 2
+    height = text_size * 1.6
+    baseline = text_size * 1.2
+
+    def build():
+        with fitz.open() as doc:
+            page = doc.new_page(width=width, height=height)
+            page.insert_text((0, baseline), watermark_text, fontsize=text_size, color=_color_key(color))
+            return doc.tobytes(garbage=OUTPUT_GARBAGE, deflate=OUTPUT_DEFLATE)
+
+    key = ("cover-text", watermark_text, text_size, _color_key(color))
+    return key, build, width, height, baseline
+
+def redact_rects(page, rects, images=REDACT_IMAGES):
+    """
+    Removes the text under rects (unrotated page coordinates) from the page and fills
+    them with white. All rects become redact annotations that are applied together, so
+    the page's content is rewritten once however many rects there are. images is a key
+    of REDACT_IMAGE_MODES.
+    """
+    for rect in rects:
+        page.add_redact_annot(rect, fill=(1, 1, 1), cross_out=False)
+    page.apply_redactions(images=REDACT_IMAGE_MODES[images])
+    count(COUNTER_REDACTIONS, len(rects))
+
+def legacy_standard_watermark(input_pdf_path, output_pdf_path, watermark_text, text_size, color, location):
+    """
+    Original locations 1-8 path: one ReportLab overlay sized from the first page,
+    merged into every page with PyPDF2. Kept for output comparison.
+    A PDF given as bytes is written back as bytes and returned.
+    """
+    in_memory = isinstance(input_pdf_path, (bytes, bytearray))
+    reader = PdfReader(BytesIO(input_pdf_path) if in_memory else input_pdf_path)
+    first_page = reader.pages[0]
+    page_width = float(first_page.mediabox.width)
+    page_height = float(first_page.mediabox.height)
+    overlay = standard_template(watermark_text, text_size, color, location, page_width, page_height)
+    watermark_page = PdfReader(BytesIO(overlay)).pages[0]
+    writer = PdfWriter()
+    with timed(PHASE_DRAW):
+        for page in reader.pages:
+            page.merge_page(watermark_page)
+            writer.add_page(page)
+    count(COUNTER_PAGES, len(reader.pages))
+    if in_memory:
+        out_stream = BytesIO()
+        with timed(PHASE_SAVE):
+            writer.write(out_stream)
+        return out_stream.getvalue()
+    with timed(PHASE_SAVE), open(output_pdf_path, "wb") as out_file:
+        writer.write(out_file)
+    return output_pdf_path
+
+def current_rss_mb():
+    """
+    Returns the resident memory of this process in MB, or 0 where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def process_pages_streaming(input_pdf_path, output_pdf_path, page_fn, chunk_pages=STREAM_CHUNK_PAGES,
+                            memory_limit_mb=MAX_MEMORY_MB):
+    """
+    Applies page_fn(page) to every page of a PDF with bounded memory.
+    The input is copied to output_pdf_path and modified in chunks of chunk_pages pages.
+    After each chunk the changes are written with an incremental save and the document
+    is reopened, so only one chunk's pages and objects are held in memory. If resident
+    memory exceeds memory_limit_mb the chunk size is halved. The finished file is
+    rewritten once by the output stage (optimize.write_output), which also drops the
+    superseded objects.
+    """
+    # Opened first, so a damaged input fails under its own name rather than the copy's.
+    fitz.open(input_pdf_path, filetype="pdf").close()
+    shutil.copyfile(input_pdf_path, output_pdf_path)
+    doc = fitz.open(output_pdf_path)
+    try:
+        if not doc.can_save_incrementally():
+            # Encrypted or repaired files cannot be appended to; process them in one pass.
+            logger.info("Incremental save not possible for %s; processing in one pass", input_pdf_path)
+            with timed(PHASE_DRAW):
+                for page in doc:
+                    page_fn(page)
+            count(COUNTER_PAGES, doc.page_count)
+            with timed(PHASE_SAVE):
+                write_output(doc, output_pdf_path + ".tmp")
+            doc.close()
+            os.replace(output_pdf_path + ".tmp", output_pdf_path)
+            return
+        page_count = doc.page_count
+        chunk_pages = max(1, chunk_pages)
+        start = 0
+        while start < page_count:
+            stop = min(start + chunk_pages, page_count)
+            with timed(PHASE_DRAW):
+                for page_number in range(start, stop):
+                    page_fn(doc[page_number])
+            count(COUNTER_PAGES, stop - start)
+            with timed(PHASE_SAVE):
+                doc.saveIncr()
+            doc.close()
+            fitz.TOOLS.store_shrink(100)
+            rss = current_rss_mb()
+            logger.debug("Pages %d-%d written, RSS %.1f MB", start, stop - 1, rss)
+            if memory_limit_mb and rss > memory_limit_mb and chunk_pages > 1:
+                chunk_pages = max(1, chunk_pages // 2)
+                logger.info("RSS %.1f MB above %d MB limit; chunk size reduced to %d page(s)",
+                            rss, memory_limit_mb, chunk_pages)
+            start = stop
+            doc = fitz.open(output_pdf_path)
+        with timed(PHASE_SAVE):
+            write_output(doc, output_pdf_path + ".tmp")
+        doc.close()
+        os.replace(output_pdf_path + ".tmp", output_pdf_path)
+    finally:
+        if not doc.is_closed:
+            doc.close()
+
+def apply_to_pages(source, output_pdf_path, page_fn):
+    """
+    Applies page_fn(page) to every page of source. A PDF given as bytes (a small file)
+    is processed in memory in one pass and the result is returned as bytes; a path is
+    processed with process_pages_streaming into output_pdf_path, which is returned.
+    """
+    if not isinstance(source, (bytes, bytearray)):
+        process_pages_streaming(source, output_pdf_path, page_fn)
+        return output_pdf_path
+    with open_pdf(source) as doc:
+        with timed(PHASE_DRAW):
+            for page in doc:
+                page_fn(page)
+        count(COUNTER_PAGES, doc.page_count)
+        with timed(PHASE_SAVE):
+            return write_output(doc)
+
+def stamp_standard_watermark(input_pdf_path, output_pdf_path, watermark_text, text_size, color, location):
+    """
+    Locations 1-8 with PyMuPDF: the overlay is compiled once per distinct visible page
+    size and rotation and stamped by reference onto each page (see TemplateStamper).
+    Positions use each page's own size and rotation, so mixed-size and rotated documents
+    are stamped correctly.
+    """
+    stamper = TemplateStamper()
+
+    def stamp(page):
+        width, height = page.rect.width, page.rect.height
+        key = ("standard", watermark_text, text_size, _color_key(color), location,
+               round(width, 2), round(height, 2), page.rotation)
+        stamper.stamp(page, key,
+                      lambda: render_watermark_overlay(watermark_text, text_size, color, location, width, height),
+                      [page.rect * page.derotation_matrix], rotate=page.rotation)
+
+    try:
+        return apply_to_pages(input_pdf_path, output_pdf_path, stamp)
+    finally:
+        stamper.close()
+
+def create_watermarked_pdf(input_pdf_path, watermark_text, text_size, color, location, find_text=None, cover_coords=None,
+                           stamp_engine=None, output_pdf_path=None, ocr_workers=None, ocr_region=None,
+                           ocr_options=None, cover_mode=None, redact_images=None, work_dir=None):
+    """
+    For locations 1-8: standard watermark.
+    For location 9 (OCR Cover-Up): covers found text (one phrase per line of find_text),
+    searching the text layer where there is one and OCRing (pytesseract) the remaining pages.
+    ocr_region (two normalized v,h corners) limits the search to part of each page, and
+    ocr_options overrides OCR settings (see ocr.ocr_settings).
+    For location 10 (Sides Cover-Up): uses two normalized coordinates (v,h on 0–10 scale)
+    to determine a rectangular region on each page, covers it with white,
+    and places the watermark text centered in that region.
+    cover_mode ("cover" or "redact") chooses how locations 9 and 10 hide an area, and
+    redact_images ("keep", "blank" or "remove") what redaction does to images under it;
+    they default to the COVER_MODE and REDACT_IMAGES settings.
+    stamp_engine selects the locations 1-8 implementation ("pymupdf" or "legacy");
+    it defaults to the STAMP_ENGINE setting.
+    The output is written next to the input unless output_pdf_path is given; ocr_workers
+    overrides OCR_WORKERS. Returns the output path.
+    input_pdf_path may also be the PDF's bytes: the file is then processed in memory and
+    the output returned as bytes. OCR in several processes needs the bytes as a file,
+    which is written to work_dir (see ocr.find_text_boxes).
+    """
+    in_memory = isinstance(input_pdf_path, (bytes, bytearray))
+    if in_memory:
+        logger.info("Creating watermarked PDF in memory (%d bytes)", len(input_pdf_path))
+    else:
+        logger.info("Creating watermarked PDF for: %s", input_pdf_path)
+        if output_pdf_path is None:
+            output_pdf_path = os.path.join(os.path.dirname(input_pdf_path),
+                                           output_name(os.path.basename(input_pdf_path)))
+    destination = "memory" if in_memory else output_pdf_path
+    cover_mode = cover_mode or COVER_MODE
+    redact_images = redact_images or REDACT_IMAGES
+    if cover_mode not in COVER_MODES:
+        raise ValueError(f"cover_mode must be one of: {', '.join(COVER_MODES)}")
+    if redact_images not in REDACT_IMAGE_MODES:
+        raise ValueError(f"redact_images must be one of: {', '.join(REDACT_IMAGE_MODES)}")
+    redact = cover_mode == "redact"
+    if location == 9 and find_text:
+        logger.info("Using OCR Cover-Up (%s) for text: %s", cover_mode, find_text)
+        boxes_by_page, methods_by_page = find_text_boxes(
+            input_pdf_path, find_text, workers=ocr_workers,
+            settings=ocr_settings(**(ocr_options or {})), region=ocr_region, work_dir=work_dir)
+        methods = list(methods_by_page.values())
+        logger.info("Cover-Up search: %d page(s) via text layer, %d via OCR index, %d via OCR",
+                    methods.count(METHOD_TEXT), methods.count(METHOD_OCR_INDEX), methods.count(METHOD_OCR))
+        key, build, width, height, baseline = cover_text_template(watermark_text, text_size, color)
+        stamper = TemplateStamper()
+
+        def cover_matches(page):
+            rects = [fitz.Rect(box) for box in boxes_by_page.get(page.number, ())]
+            if not rects:
+                return
+            if redact:
+                redact_rects(page, rects, redact_images)
+            # The text's baseline goes 2pt below each match, as insert_text did.
+            stamper.stamp(page, key, build,
+                          [fitz.Rect(r.x0, r.y1 + 2 - baseline, r.x0 + width, r.y1 + 2 - baseline + height)
+                           for r in rects],
+                          cover=() if redact else rects)
+            logger.debug("Applied OCR watermark on page %d at %d rect(s)", page.number, len(rects))
+
+        try:
+            result = apply_to_pages(input_pdf_path, output_pdf_path, cover_matches)
+        finally:
+            stamper.close()
+        logger.info("OCR watermarked PDF saved: %s", destination)
+        return result
+
+    elif location == 10 and cover_coords and len(cover_coords) == 2:
+        logger.info("Using Sides Cover-Up (%s) with coordinates: %s", cover_mode, cover_coords)
+        stamper = TemplateStamper()
+
+        # Sides Cover-Up applied to every page, compiled once per page size and rotation.
+        def cover_sides(page):
+            if redact:
+                redact_rects(page, [normalized_rect(page, cover_coords)], redact_images)
+            width, height = page.rect.width, page.rect.height
+            key = ("sides", watermark_text, text_size, _color_key(color), tuple(map(tuple, cover_coords)),
+                   round(width, 2), round(height, 2), page.rotation)
+            stamper.stamp(page, key,
+                          lambda: render_sides_template(watermark_text, text_size, color, cover_coords, width, height),
+                          [page.rect * page.derotation_matrix], rotate=page.rotation)
+            logger.debug("Applied Sides Cover-Up on page %d", page.number)
+
+        try:
+            result = apply_to_pages(input_pdf_path, output_pdf_path, cover_sides)
+        finally:
+            stamper.close()
+        logger.info("Sides watermarked PDF saved: %s", destination)
+        return result
+
+    else:
+        engine = stamp_engine or STAMP_ENGINE
+        if engine == "legacy":
+            result = legacy_standard_watermark(
+                input_pdf_path, output_pdf_path, watermark_text, text_size, color, location)
+        else:
+            result = stamp_standard_watermark(
+                input_pdf_path, output_pdf_path, watermark_text, text_size, color, location)
+        logger.info("Standard watermarked PDF saved: %s", destination)
+        return result
@@ -0,0 +1,211 @@
+import asyncio
+import functools
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import PROFILE_DIR
+from metrics import COUNTER_JOBS_COMPLETED, COUNTER_JOBS_FAILED, count, merge, run_instrumented
+
+logger = logging.getLogger(__name__)
+
+_in_worker = False  # set in the processes of a WorkerPool
+
+
+def in_worker():
+    """Returns True inside a process of a WorkerPool."""
+    return _in_worker
+
+
+def _init_worker(initializer, initargs):
+    global _in_worker
+    _in_worker = True
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class QueueFullError(Exception):
+    """Raised when the global job queue has reached its depth limit."""
+
+
+class Job:
+    """
+    A unit of CPU-bound work submitted to the WorkerPool.
+    Await the job to get the function's result. `position` is the job's place in the
+    queue at submission time (0 when it started running immediately). Once finished,
+    `metrics` holds the phases and counters the job accumulated in its worker.
+    """
+
+    def __init__(self, chat_id, fn, args, kwargs, future):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.position = 0
+        self.started = False
+        self.cancelled = False
+        self.metrics = None
+
+    def __await__(self):
+        return self.future.__await__()
+
+
+class WorkerPool:
+    """
+    Runs CPU-bound functions (PDF rendering, OCR, merging) in a process pool so the
+    pyrogram event loop stays responsive.
+
+    Jobs are queued per chat and dispatched round-robin across chats, so one chat
+    sending many large PDFs cannot starve the others. At most `max_queue_depth`
+    jobs may wait at once; beyond that submit() raises QueueFullError.
+
+    If a worker process dies (out of memory, a crash inside MuPDF), the jobs running at
+    that moment fail with BrokenProcessPool and a fresh process pool runs the rest.
+
+    `process_setup`, if given, is called each time a process pool starts and returns
+    (initializer, initargs) to run in each of its processes, e.g. to hand them state
+    they share (see ocr.ocr_process_setup).
+    """
+
+    def __init__(self, workers, max_queue_depth, process_setup=None):
+        self.workers = max(1, workers)
+        self.max_queue_depth = max_queue_depth
+        self.process_setup = process_setup
+        self._executor = None
+        self._pending = {}  # chat_id -> deque of waiting jobs
+        self._rotation = deque()  # chat_ids with waiting jobs, in dispatch order
+        self._running = set()
+
+    @property
+    def queue_depth(self):
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    def _get_executor(self):
+        if self._executor is None:
+            logger.info("Starting worker pool with %d process(es)", self.workers)
+            initializer, initargs = self.process_setup() if self.process_setup else (None, ())
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                 initargs=(initializer, initargs))
+        return self._executor
+
+    def _discard_executor(self, executor):
+        """Drops a broken executor, so the next job starts a new process pool."""
+        if executor is self._executor:
+            logger.warning("A worker process died; restarting the worker pool")
+            executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, chat_id, fn, *args, **kwargs):
+        """
+        Queues fn(*args, **kwargs) for the given chat and returns a Job.
+        Raises QueueFullError if the queue depth limit has been reached.
+        """
+        if self.queue_depth >= self.max_queue_depth:
+            raise QueueFullError(f"Job queue is full ({self.max_queue_depth} waiting)")
+        loop = asyncio.get_running_loop()
+        job = Job(chat_id, fn, args, kwargs, loop.create_future())
+        if chat_id not in self._pending:
+            self._pending[chat_id] = deque()
+            self._rotation.append(chat_id)
+        self._pending[chat_id].append(job)
+        self._dispatch()
+        if not job.started:
+            job.position = self._queue_position(job)
+            logger.info("Queued job for chat %s at position %d", chat_id, job.position)
+        return job
+
+    def _queue_position(self, job):
+        """Returns the 1-based position of a waiting job in round-robin dispatch order."""
+        queues = [list(self._pending[chat_id]) for chat_id in self._rotation]
+        position = 0
+        round_index = 0
+        while any(round_index < len(q) for q in queues):
+            for q in queues:
+                if round_index < len(q):
+                    position += 1
+                    if q[round_index] is job:
+                        return position
+            round_index += 1
+        return position
+
+    def _dispatch(self):
+        while self._rotation and len(self._running) < self.workers:
+            chat_id = self._rotation.popleft()
+            jobs = self._pending[chat_id]
+            job = jobs.popleft()
+            if jobs:
+                self._rotation.append(chat_id)
+            else:
+                del self._pending[chat_id]
+            self._start(job)
+
+    def _start(self, job):
+        loop = asyncio.get_running_loop()
+        job.started = True
+        self._running.add(job)
+        call = functools.partial(run_instrumented, job.fn, job.args, job.kwargs, PROFILE_DIR,
+                                 f"chat{job.chat_id}-{job.fn.__name__}")
+        try:
+            executor = self._get_executor()
+            try:
+                exec_future = loop.run_in_executor(executor, call)
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                executor = self._get_executor()
+                exec_future = loop.run_in_executor(executor, call)
+        except Exception as e:
+            self._running.discard(job)
+            if not job.future.done():
+                job.future.set_exception(e)
+            return
+        exec_future.add_done_callback(functools.partial(self._finish, job, executor))
+
+    def _finish(self, job, executor, exec_future):
+        self._running.discard(job)
+        failed = exec_future.cancelled() or exec_future.exception() is not None
+        if not exec_future.cancelled() and isinstance(exec_future.exception(), BrokenProcessPool):
+            self._discard_executor(executor)
+        count(COUNTER_JOBS_FAILED if failed else COUNTER_JOBS_COMPLETED)
+        if not failed:
+            result, job.metrics = exec_future.result()
+            merge(job.metrics)
+        if not job.future.done():
+            if job.cancelled:
+                job.future.cancel()
+            elif exec_future.exception() is not None:
+                job.future.set_exception(exec_future.exception())
+            else:
+                job.future.set_result(result)
+        elif not exec_future.cancelled() and exec_future.exception() is not None:
+            logger.warning("Cancelled job for chat %s failed: %s", job.chat_id, exec_future.exception())
+        self._dispatch()
+
+    def cancel_chat(self, chat_id):
+        """
+        Cancels every job belonging to a chat. Waiting jobs are dropped from the queue;
+        jobs already running in a worker cannot be interrupted, so their futures are
+        cancelled and their results discarded when they finish.
+        Returns the number of jobs cancelled.
+        """
+        cancelled = 0
+        for job in self._pending.pop(chat_id, ()):
+            job.cancelled = True
+            job.future.cancel()
+            cancelled += 1
+        if chat_id in self._rotation:
+            self._rotation.remove(chat_id)
+        for job in list(self._running):
+            if job.chat_id == chat_id and not job.cancelled:
+                job.cancelled = True
+                job.future.cancel()
+                cancelled += 1
+        if cancelled:
+            logger.info("Cancelled %d job(s) for chat %s", cancelled, chat_id)
+        return cancelled
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
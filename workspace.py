@@ -0,0 +1,82 @@
+import os
+import shutil
+import logging
+import tempfile
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FILE_NAME = "document.pdf"
+
+
+def safe_file_name(name):
+    """
+    Returns a file name that is safe to create inside a directory: the last path
+    component of name, or DEFAULT_FILE_NAME when there is none (Telegram documents
+    do not always have a name).
+    """
+    name = os.path.basename((name or "").replace("\\", "/")).strip()
+    if name in ("", ".", ".."):
+        return DEFAULT_FILE_NAME
+    return name
+
+
+def output_name(file_name, suffix="_watermarked"):
+    """
+    Returns the name of the output for an input file name: "a.pdf" -> "a_watermarked.pdf",
+    "X.PDF" -> "X_watermarked.PDF", "a.pdf.pdf" -> "a.pdf_watermarked.pdf". A name without
+    a .pdf extension keeps its name and gets suffix plus ".pdf".
+    """
+    root, ext = os.path.splitext(file_name)
+    if ext.lower() == ".pdf":
+        return root + suffix + ext
+    return file_name + suffix + ".pdf"
+
+
+def open_pdf(source):
+    """
+    Opens a PDF given as a path or as its bytes.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+class Workspace:
+    """
+    A private temporary directory for one job. Used as a context manager, it is removed
+    with everything in it on exit, also when the job raises or is cancelled. Files of
+    different items go to numbered subdirectories, so equal file names never collide.
+    """
+
+    def __init__(self, prefix="pdfwm-job-"):
+        self.prefix = prefix
+        self.path = None
+
+    def __enter__(self):
+        self.path = tempfile.mkdtemp(prefix=self.prefix)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.remove()
+
+    def item_dir(self, index):
+        path = os.path.join(self.path, str(index))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def file_path(self, index, file_name):
+        """
+        Returns a path for file_name in item index's subdirectory.
+        """
+        return os.path.join(self.item_dir(index), safe_file_name(file_name))
+
+    def remove_item(self, index):
+        shutil.rmtree(os.path.join(self.path, str(index)), ignore_errors=True)
+
+    def remove(self):
+        if self.path:
+            shutil.rmtree(self.path, ignore_errors=True)
+            logger.debug("Removed workspace %s", self.path)
+            self.path = None